@@ -11,18 +11,28 @@ to decimal: https://www.youtube.com/watch?v=v3-a-zqKfgA
 
 from pyemul.cpu import Processor
 from pyemul.mmu import MMU
-import os
+from precomputed_divide import HALT_ADDR, snapshot
+from pathlib import Path
+import pickle
+
+# Files live alongside this script, wherever it is run from
+files = Path(__file__).resolve().parent / 'files'
 
 # Read in compiled programme from file
-cwd = os.getcwd()
-filename = os.path.join(cwd, 'files', 'dividenumber.out')
-with open(filename, 'rb') as fi:
-    instructions = fi.read()
+instructions = (files / 'dividenumber.out').read_bytes()
 
 mems = MMU(((0, 0x3fff, 'RAM', False),
-            (0x8000, len(instructions)-1, 'ROM', True, instructions)))
+            (0x8000, None, 'ROM', True, instructions)))
 
 divide = Processor(mems)
 
-for _ in range(230):
-    divide.step()
+# Run until the programme reaches the loop it finishes in
+divide.run_until(HALT_ADDR)
+
+# Check against result pinned by precomputed_divide.py
+expected = pickle.loads((files / 'dividenumber.pkl').read_bytes())
+
+if snapshot(divide, mems) == expected:
+    print('Result matches pinned snapshot')
+else:
+    print('Result does not match pinned snapshot')
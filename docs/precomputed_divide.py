@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 14 11:02:47 2026
+
+@author: SamHill
+
+Runs the binary to decimal programme from my_first_computer.py through the
+emulator once, and pins the final state of the registers and RAM to a file.
+my_first_computer.py then checks the emulator against this snapshot, so any
+change to the emulator core can be checked to still give the same answer.
+
+Only needs re-running if the programme itself changes.
+"""
+
+from pyemul.cpu import Processor
+from pyemul.mmu import MMU
+from pathlib import Path
+import pickle
+
+# Address of 'loop: jmp loop', which the programme finishes in
+HALT_ADDR = 0x8040
+
+
+def snapshot(cpu: Processor, mems: MMU) -> dict:
+    '''
+    Takes a copy of the registers, cycle count and contents of RAM
+    '''
+    return {'a': cpu.r.a, 'x': cpu.r.x, 'y': cpu.r.y, 'sp': cpu.r.sp,
+            'pc': cpu.r.pc, 'p': cpu.r.p, 'cycles': cpu.cycles,
+            'ram': bytes(mems.memory[0:0x4000])}
+
+
+if __name__ == '__main__':
+    # Files live alongside this script, wherever it is run from
+    files = Path(__file__).resolve().parent / 'files'
+
+    # Read in compiled programme from file
+    instructions = (files / 'dividenumber.out').read_bytes()
+
+    mems = MMU(((0, 0x3fff, 'RAM', False),
+                (0x8000, None, 'ROM', True, instructions)))
+
+    divide = Processor(mems)
+    while divide.r.pc != HALT_ADDR:
+        divide.step()
+
+    # Store final state of computer
+    (files / 'dividenumber.pkl').write_bytes(pickle.dumps(snapshot(divide, mems)))
@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 14 10:12:31 2026
+
+@author: SamHill
+
+Generates specialised Python code for runs of instructions held in ROM.
+Because ROM cannot change, each instruction's operation, operand and cycle
+count are known ahead of time, so a straight-line run of them can be written
+out as one Python function with all the decoding and dispatch already done.
+Each opcode also gets its own function that fetches, decodes and executes it
+in one go, used for instructions that have not been predecoded.
+"""
+import re
+from functools import lru_cache
+from types import CodeType
+from typing import Callable, Union
+
+from .mmu import ReadOnlyError
+
+
+# Instructions that change the flow of the programme. A block always finishes
+# with one of these, as the next instruction to run is not known ahead of time
+BLOCK_END = {'BCC', 'BCS', 'BEQ', 'BMI', 'BNE', 'BPL', 'BVC', 'BVS',
+             'BRK', 'JMP', 'JSR', 'RTI', 'RTS'}
+
+# Instructions that write to memory, at the address they are given, and those
+# that push onto the stack. A block of code in writable memory checks where
+# these write, in case it is changing its own code (see compile_ram_block).
+# JSR and BRK write too, but always finish a block anyway
+WRITES_MEMORY = {'STA', 'STX', 'STY', 'INC', 'DEC', 'ASL', 'LSR', 'ROL',
+                 'ROR'}
+PUSHES = {'PHA', 'PHP'}
+
+# Matches source for an address that is known when the block is compiled
+_CONSTANT = re.compile(r'0x[0-9a-f]+|\d+')
+
+# Source for addressing modes that can be written straight into a handler,
+# rather than called, keyed by the name of the Processor method they replace.
+# Each is a 2-tuple of (lines to run first, expression for the value passed to
+# the instruction), which can use operand, cpu, registers r and memory mem.
+# Extra cycles for crossing a page are added to the local page_cross, which
+# the generated function adds to the cycle count at the end (see
+# _uses_page_cross). These must do exactly the same as the methods in cpu.py.
+# A method overridden by a subclass of Processor is always called instead
+_SET_ADDR_X = ('addr = (operand + r.x) & 0xffff',
+               'page_cross += ((operand & 0xff) + r.x) >> 8')
+_SET_ADDR_Y = ('addr = (operand + r.y) & 0xffff',
+               'page_cross += ((operand & 0xff) + r.y) >> 8')
+_SET_ADDR_IX = ('ptr = (operand + r.x) & 0xff',
+                'addr = (mem[(ptr + 1) & 0xff] << 8) + mem[ptr]')
+_SET_ADDR_IY = ('ptr = (mem[(operand + 1) & 0xff] << 8) + mem[operand]',
+                'addr = (ptr + r.y) & 0xffff',
+                'page_cross += ((ptr & 0xff) + r.y) >> 8')
+MODE_SOURCE = {
+    '_zero_page_value': ((), 'mem[operand]'),
+    '_zero_page_x': ((), '(operand + r.x) & 0xff'),
+    '_zero_page_x_value': ((), 'mem[(operand + r.x) & 0xff]'),
+    '_zero_page_y': ((), '(operand + r.y) & 0xff'),
+    '_zero_page_y_value': ((), 'mem[(operand + r.y) & 0xff]'),
+    '_load_addr_value': ((), 'mem[operand]'),
+    '_load_addr_x': (_SET_ADDR_X, 'addr'),
+    '_load_addr_x_value': (_SET_ADDR_X, 'mem[addr]'),
+    '_load_addr_y': (_SET_ADDR_Y, 'addr'),
+    '_load_addr_y_value': (_SET_ADDR_Y, 'mem[addr]'),
+    '_load_ix': (_SET_ADDR_IX, 'addr'),
+    '_load_ix_value': (_SET_ADDR_IX, 'mem[addr]'),
+    '_load_iy': (_SET_ADDR_IY, 'addr'),
+    '_load_iy_value': (_SET_ADDR_IY, 'mem[addr]'),
+    '_relative': ((), '(r.pc + (operand & 0x7f) - (operand & 0x80)) & 0xffff'),
+}
+
+# Source for operations that can be written straight into a handler or block,
+# keyed by the name of the Processor method they replace. The lines work on
+# the local value, given to the instruction as its argument. ADC and SBC are
+# written out for binary mode, as decimal mode is rarely used - it just calls
+# the method instead. Carry, overflow and decimal aren't affected by pending
+# zero and negative flags, so these work on _p directly. These must do exactly
+# the same as the methods in cpu.py. A method overridden by a subclass of
+# Processor is always called instead
+_STORE = ('if cpu._read_only[value]:',
+          '    raise ReadOnlyError()')
+OP_SOURCE = {
+    'ADC': ('if r._p & 0x08:',
+            '    ADC(cpu, value)',
+            'else:',
+            '    a = r.a',
+            '    p = r._p',
+            '    result = a + value + (p & 0x01)',
+            '    r.a = r._zn = result & 0xff',
+            '    overflow = (~(a ^ value)) & (a ^ result) & 0x80',
+            '    r._p = (p & 0xbe) | (overflow >> 1) | (result > 0xff)'),
+    'SBC': ('if r._p & 0x08:',
+            '    SBC(cpu, value)',
+            'else:',
+            '    a = r.a',
+            '    p = r._p',
+            '    result = a - value - ((p & 0x01) ^ 1)',
+            '    r.a = r._zn = result & 0xff',
+            '    overflow = (a ^ value) & (a ^ result) & 0x80',
+            '    r._p = (p & 0xbe) | (overflow >> 1) | (result >= 0)'),
+    'AND': ('r.a = r._zn = r.a & value',),
+    'EOR': ('r.a = r._zn = r.a ^ value',),
+    'ORA': ('r.a = r._zn = r.a | value',),
+    'CMP': ('r._p = (r._p & 0xfe) | (value <= r.a)',
+            'r._zn = (r.a - value) & 0xff'),
+    'CPX': ('r._p = (r._p & 0xfe) | (value <= r.x)',
+            'r._zn = (r.x - value) & 0xff'),
+    'CPY': ('r._p = (r._p & 0xfe) | (value <= r.y)',
+            'r._zn = (r.y - value) & 0xff'),
+    'LDA': ('r.a = r._zn = value',),
+    'LDX': ('r.x = r._zn = value',),
+    'LDY': ('r.y = r._zn = value',),
+    'STA': _STORE + ('mem[value] = r.a',),
+    'STX': _STORE + ('mem[value] = r.x',),
+    'STY': _STORE + ('mem[value] = r.y',),
+    'DEX': ('r.x = r._zn = (r.x - 1) & 0xff',),
+    'DEY': ('r.y = r._zn = (r.y - 1) & 0xff',),
+    'INX': ('r.x = r._zn = (r.x + 1) & 0xff',),
+    'INY': ('r.y = r._zn = (r.y + 1) & 0xff',),
+    'TAX': ('r.x = r._zn = r.a',),
+    'TAY': ('r.y = r._zn = r.a',),
+    'TSX': ('r.x = r._zn = r.sp',),
+    'TXA': ('r.a = r._zn = r.x',),
+    'TXS': ('r.sp = r.x',),
+    'TYA': ('r.a = r._zn = r.y',),
+    'CLR': ('r.p = r.p & (0xff ^ value)',),
+    'SET': ('r.p = r.p | value',),
+    'JMP': ('r.pc = value',),
+    'NOP': (),
+}
+
+
+def _is_processor_method(func: Callable) -> bool:
+    '''
+    Whether func is the Processor method of the same name, rather than one
+    overridden by a subclass - only then can its source be written out in
+    its place
+    '''
+    # Imported here, as cpu imports this module
+    from .cpu import Processor
+    return getattr(Processor, func.__name__, None) is func
+
+
+def _is_inlined(decoded: tuple) -> bool:
+    '''
+    Whether neither the instruction nor the addressing mode of a decoded
+    instruction is overridden by a subclass, so both can be written out
+    '''
+    argument = decoded[2]
+    return _is_processor_method(decoded[1].__func__) and \
+        (argument is None or _is_processor_method(argument.__func__))
+
+
+def _operation_source(func: Callable, value: str) -> list[str]:
+    '''
+    Lines that run the operation of the Processor method func on value,
+    written out in full if it is in OP_SOURCE and not overridden. A value
+    that is just a name or a number is written straight in, anything else is
+    worked out once first
+    '''
+    name = func.__name__
+    if name not in OP_SOURCE or not _is_processor_method(func):
+        return [f'{name}(cpu, {value})']
+    elif re.fullmatch(r'\w+', value):
+        return [re.sub(r'\bvalue\b', value, line) for line in OP_SOURCE[name]]
+    return [f'value = {value}', *OP_SOURCE[name]]
+
+
+def _uses_page_cross(lines: list[str]) -> bool:
+    '''
+    Whether any of the lines add to page_cross, so it needs setting up
+    '''
+    return any('page_cross' in line for line in lines)
+
+
+@lru_cache(maxsize=4096)
+def _compile_source(source: str, filename: str) -> CodeType:
+    '''
+    Compiles the source for a block. Compiling is by far the slowest part of
+    generating a block, so compiled code is cached - any processor running
+    the same ROM (or the same one after a reset) reuses it
+    '''
+    return compile(source, filename, 'exec')
+
+
+def compile_block(cpu, start_addr: int,
+                  max_length: int = 64
+                  ) -> Union[None, tuple[Callable, int, int]]:
+    '''
+    Compiles the run of predecoded instructions starting at start_addr into a
+    single function, which takes the processor as its only argument. The run
+    finishes after an instruction in BLOCK_END, at the first address that has
+    not been predecoded, or after max_length instructions.
+
+    Each instruction's operand is known, so it is written into the source as
+    a constant: addressing modes in MODE_SOURCE are written out with the
+    operand filled in, and branch targets are worked out in advance. The
+    cycles for the whole block are added in one go at the end. The function
+    returns the number of instructions it ran.
+
+    Returns a 3-tuple of (function, number of instructions in block, address
+    just past the end of the block), or None if there is no predecoded
+    instruction at start_addr.
+    '''
+    run = []
+    addr = start_addr
+    while len(run) < max_length:
+        decoded = cpu._decoded[addr]
+        if decoded is None:
+            break
+        run.append((addr, decoded))
+        addr = decoded[5]
+        if decoded[1].__name__ in BLOCK_END:
+            break
+
+    return _compile_run(cpu, run)
+
+
+def compile_ram_block(cpu, start_addr: int,
+                      max_length: int = 64
+                      ) -> Union[None, tuple[Callable, int, int]]:
+    '''
+    Compiles the run of instructions starting at start_addr in the same way
+    as compile_block, but decodes them from memory as they are now, so can be
+    used for code in writable memory. The run also finishes before an invalid
+    instruction, or one that would run past the top of memory. Nothing checks
+    that the code stays the same before it runs - the caller must do that.
+    Once running, any write to memory inside the block (see WRITES_MEMORY)
+    leaves it straight after that instruction, with the program counter on
+    the next instruction, as the rest of the block may no longer match the
+    code. The function returns the number of instructions it ran.
+
+    Returns a 3-tuple of (function, number of instructions in block, address
+    just past the end of the block), or None if there is no valid instruction
+    at start_addr.
+    '''
+    run = []
+    addr = start_addr
+    while len(run) < max_length:
+        if cpu._op_table[cpu._mem[addr]] is None:
+            break
+        decoded = cpu.decode(addr)
+        if decoded[5] <= addr:
+            break
+        run.append((addr, decoded))
+        addr = decoded[5]
+        if decoded[1].__name__ in BLOCK_END:
+            break
+
+    return _compile_run(cpu, run, guard=True)
+
+
+def _value_source(cpu, decoded: tuple, namespace: dict,
+                  lines: list[str]) -> str:
+    '''
+    Adds any lines needed to work out the value passed to a decoded
+    instruction, and returns the expression for the value itself
+    '''
+    name, instruction, argument, operand, cycles, next_pc = decoded
+    if argument is None:
+        return repr(operand)
+
+    mode = argument.__func__
+    if not _is_processor_method(mode):
+        namespace[mode.__name__] = mode
+        return f'{mode.__name__}(cpu, {operand!r})'
+    elif mode.__name__ == '_relative':
+        # Branch target is relative to the next instruction
+        target = cpu._relative_target(next_pc, operand)
+        return f'0x{target:04x}'
+    elif mode.__name__ in MODE_SOURCE:
+        setup, value = MODE_SOURCE[mode.__name__]
+        constant = f'0x{operand:04x}'
+        lines += ['    ' + re.sub(r'\boperand\b', constant, line)
+                  for line in setup]
+        return re.sub(r'\boperand\b', constant, value)
+    else:
+        namespace[mode.__name__] = mode
+        return f'{mode.__name__}(cpu, {operand!r})'
+
+
+def _branch_source(cpu, branch: tuple, condition: str) -> list[str]:
+    '''
+    Lines that take a decoded branch instruction if condition is true
+    '''
+    next_pc, operand = branch[5], branch[3]
+    target = cpu._relative_target(next_pc, operand)
+    return [f'    if {condition}:',
+            f'        r.pc = 0x{target:04x}',
+            f'        cpu.cycles += {cpu._branch_cycles(next_pc, target)}']
+
+
+def _fuse_load_store(cpu, first: tuple, second: tuple, namespace: dict,
+                     lines: list[str]) -> str:
+    '''
+    Load a register then store it straight back to memory, e.g. LDA then STA.
+    Returns the expression for the address written to
+    '''
+    register = first[1].__name__[-1].lower()
+    value = _value_source(cpu, first, namespace, lines)
+    lines += [f'    r.{register} = r._zn = {value}']
+    addr = _value_source(cpu, second, namespace, lines)
+    lines += [f'    dst = {addr}',
+              '    if cpu._read_only[dst]:',
+              '        raise ReadOnlyError()',
+              f'    mem[dst] = r.{register}']
+    return addr if _CONSTANT.fullmatch(addr) else 'dst'
+
+
+def _fuse_step_branch(cpu, first: tuple, second: tuple, namespace: dict,
+                      lines: list[str]) -> None:
+    '''
+    Increment or decrement an index register then branch on whether it has
+    reached zero, e.g. the end of a DEX, BNE loop
+    '''
+    name = first[1].__name__
+    register = name[-1].lower()
+    step = '+' if name.startswith('IN') else '-'
+    lines += [f'    r.{register} = r._zn = (r.{register} {step} 1) & 0xff']
+    test = '' if second[1].__name__ == 'BNE' else 'not '
+    lines += _branch_source(cpu, second, f'{test}r.{register}')
+
+
+def _fuse_compare_branch(cpu, first: tuple, second: tuple, namespace: dict,
+                         lines: list[str]) -> None:
+    '''
+    Compare a register with a value then branch on whether they are equal
+    '''
+    register = {'CMP': 'a', 'CPX': 'x', 'CPY': 'y'}[first[1].__name__]
+    value = _value_source(cpu, first, namespace, lines)
+    lines += [f'    value = {value}',
+              f'    r._p = (r._p & 0xfe) | (value <= r.{register})',
+              f'    r._zn = (r.{register} - value) & 0xff']
+    test = '!=' if second[1].__name__ == 'BNE' else '=='
+    lines += _branch_source(cpu, second, f'r.{register} {test} value')
+
+
+# Common pairs of instructions that blocks run as one, keyed by the names of
+# the two Processor methods. The operations are written out in full, so the
+# pair needs no calls at all. Blocks are compiled for the address they start
+# at, so a branch into the middle of a pair gets a block of its own. Pairs
+# where either method is overridden by a subclass of Processor aren't fused.
+# Each returns the expression for the address the pair writes to, if any
+FUSED = {}
+FUSED.update({(load, 'ST' + load[-1]): _fuse_load_store
+              for load in ('LDA', 'LDX', 'LDY')})
+FUSED.update({(step, branch): _fuse_step_branch
+              for step in ('INX', 'INY', 'DEX', 'DEY')
+              for branch in ('BEQ', 'BNE')})
+FUSED.update({(compare, branch): _fuse_compare_branch
+              for compare in ('CMP', 'CPX', 'CPY')
+              for branch in ('BEQ', 'BNE')})
+
+
+def _guard_source(start: int, end: int, addr: str, count: int,
+                  total_cycles: int) -> list[str]:
+    '''
+    Lines that leave a block running from start up to end if addr, the
+    address just written to, is inside it - count instructions and
+    total_cycles cycles have run by then
+    '''
+    return [f'    if 0x{start:04x} <= {addr} < 0x{end:04x}:',
+            f'        cpu.cycles += {total_cycles} + page_cross',
+            f'        return {count}']
+
+
+def _compile_run(cpu, run: list[tuple[int, tuple]], guard: bool = False
+                 ) -> Union[None, tuple[Callable, int, int]]:
+    '''
+    Compiles a run of decoded instructions, given as a list of (address,
+    decoded instruction) pairs, into a single function - see compile_block.
+    Pairs of instructions in FUSED are written out in full. If guard is set,
+    the function leaves early after writing to memory inside the run (see
+    compile_ram_block)
+    '''
+    if not run:
+        return None
+
+    namespace = {'ReadOnlyError': ReadOnlyError}
+    lines = ['def block(cpu):',
+             '    r = cpu.r',
+             '    mem = cpu._mem']
+    start, end = run[0][0], run[-1][1][5]
+    stack_base = cpu._stack_base
+
+    total_cycles = 0
+    count = 0
+    index = 0
+    while index < len(run):
+        addr, decoded = run[index]
+        name, instruction, argument, operand, cycles, next_pc = decoded
+
+        fuse = None
+        if index + 1 < len(run):
+            second = run[index + 1][1]
+            fuse = FUSED.get((instruction.__name__, second[1].__name__))
+            if fuse is not None and not (_is_inlined(decoded) and
+                                         _is_inlined(second)):
+                fuse = None
+        if fuse is not None:
+            # Neither instruction of a pair reads the program counter before
+            # the branch, so it can move past both of them straight away
+            next_pc = second[5]
+            lines += [f'    # ${addr:04x} {name}, {second[0]}',
+                      f'    r.pc = 0x{next_pc:04x}']
+            written = fuse(cpu, decoded, second, namespace, lines)
+            total_cycles += cycles + second[4]
+            count += 2
+            index += 2
+        else:
+            # Call the underlying functions, so the block doesn't need to look
+            # up the bound methods on the processor each time it is run
+            func = instruction.__func__
+            namespace[func.__name__] = func
+            lines += [f'    # ${addr:04x} {name}',
+                      f'    r.pc = 0x{next_pc:04x}']
+            value = _value_source(cpu, decoded, namespace, lines)
+            written = None
+            if func.__name__ in WRITES_MEMORY and value != "'a'":
+                # Only work out the address once, for the check after
+                if guard and not re.fullmatch(r'\w+', value):
+                    lines += [f'    value = {value}']
+                    value = 'value'
+                written = value
+            elif func.__name__ in PUSHES and \
+                    start < stack_base + 0x100 and end > stack_base:
+                written = f'(0x{stack_base:04x} | ((r.sp + 1) & 0xff))'
+            lines += [f'    {line}'
+                      for line in _operation_source(func, value)]
+            total_cycles += cycles
+            count += 1
+            index += 1
+
+        if guard and written is not None:
+            if not _CONSTANT.fullmatch(written):
+                lines += _guard_source(start, end, written, count,
+                                       total_cycles)
+            elif start <= int(written, 0) < end:
+                # Always writes over the block, so never gets any further
+                break
+
+    if _uses_page_cross(lines):
+        # Start counting just after r and mem are set up
+        lines.insert(3, '    page_cross = 0')
+        lines += [f'    cpu.cycles += {total_cycles} + page_cross']
+    else:
+        lines += [f'    cpu.cycles += {total_cycles}']
+    lines += [f'    return {count}']
+
+    source = '\n'.join(lines) + '\n'
+    exec(_compile_source(source, f'<block ${start:04x}>'), namespace)
+    return namespace['block'], count, next_pc
+
+
+def compile_handler(cpu, opcode: int) -> Callable:
+    '''
+    Compiles a function that fetches, decodes and executes an instruction with
+    the given opcode from the current program counter, taking the processor as
+    its only argument. The operand fetch, addressing mode, operation and cycle
+    count are all written into the one function, so running it needs no look
+    up in the opcode table. Addressing modes in MODE_SOURCE are written out in
+    full, so the operation is the only call made - and operations in
+    OP_SOURCE are written out too. An invalid opcode gives a function that
+    raises InvalidInstructionError.
+    '''
+    namespace = {'ReadOnlyError': ReadOnlyError}
+    lines = [f'def op_{opcode:02x}(cpu):']
+
+    op = cpu._op_table[opcode]
+    if op is None:
+        # Leave decode to raise the error
+        lines += ['    cpu.decode(cpu.r.pc)']
+    else:
+        name, instruction, argument, cycles = op
+        func = instruction.__func__
+        namespace[func.__name__] = func
+        lines += [f'    # {name}',
+                  '    r = cpu.r',
+                  '    mem = cpu._mem',
+                  '    pc = r.pc']
+
+        # Work out how to get the value passed to the instruction
+        setup = []
+        if not callable(argument):
+            length = 0
+            value = repr(argument)
+        else:
+            length = cpu._operand_bytes[argument]
+            if length == 0:
+                operand = 'None'
+            elif length == 1:
+                operand = 'operand'
+                setup += ['operand = mem[(pc + 1) & 0xffff]']
+            else:
+                operand = 'operand'
+                setup += ['operand = (mem[(pc + 2) & 0xffff] << 8) + '
+                          'mem[(pc + 1) & 0xffff]']
+
+            mode = argument.__func__
+            if argument in cpu._static_modes:
+                value = operand
+            elif mode.__name__ in MODE_SOURCE and _is_processor_method(mode):
+                mode_setup, value = MODE_SOURCE[mode.__name__]
+                setup += mode_setup
+            else:
+                namespace[mode.__name__] = mode
+                value = f'{mode.__name__}(cpu, {operand})'
+
+        # Program counter moves on first, as relative addressing depends on it
+        lines += [f'    r.pc = (pc + {1 + length}) & 0xffff']
+        operation = _operation_source(func, value)
+        if _uses_page_cross(setup):
+            lines += ['    page_cross = 0']
+            lines += [f'    {line}' for line in setup + operation]
+            lines += [f'    cpu.cycles += {cycles} + page_cross']
+        else:
+            lines += [f'    {line}' for line in setup + operation]
+            lines += [f'    cpu.cycles += {cycles}']
+
+    # Each opcode is compiled on its own, so gets its own code object
+    source = '\n'.join(lines) + '\n'
+    exec(_compile_source(source, f'<opcode ${opcode:02x}>'), namespace)
+    return namespace[f'op_{opcode:02x}']
+
+
+# Handlers compiled by compile_handlers, keyed by the functions behind each
+# opcode - see _handler_key
+_handler_cache = {}
+
+
+def _handler_key(cpu) -> tuple:
+    '''
+    The functions behind each opcode in the processor's opcode table, with
+    its name, fixed argument and cycle count. Handlers only depend on these
+    (they take the processor as an argument), so every processor with the
+    same key can share them - i.e. instances of the same class, or of
+    subclasses that override the same methods
+    '''
+    key = []
+    for op in cpu._op_table:
+        if op is None:
+            key.append(None)
+            continue
+        name, instruction, argument, cycles = op
+        if callable(argument):
+            argument = argument.__func__
+        key.append((name, instruction.__func__, argument, cycles))
+    return tuple(key)
+
+
+def compile_handlers(cpu) -> list[Callable]:
+    '''
+    Compiles a handler (see compile_handler) for every possible opcode,
+    returned as a list indexed by opcode. Generating them is much slower than
+    the rest of setting up a processor, so they are only generated once for
+    each set of methods (see _handler_key)
+    '''
+    key = _handler_key(cpu)
+    handlers = _handler_cache.get(key)
+    if handlers is None:
+        handlers = [compile_handler(cpu, opcode) for opcode in range(0x100)]
+        _handler_cache[key] = handlers
+    return list(handlers)
@@ -4,29 +4,64 @@ Created on Mon Sep  5 18:09:53 2022
 
 @author: SamHill
 """
-import math
-from .mmu import MMU
+from typing import Union
+from .codegen import BLOCK_END, compile_block, compile_handlers, \
+    compile_ram_block
+from .mmu import MMU, ReadOnlyError
+
+
+# Masks for each flag in the process status register
+N_FLAG = 0x80       # Negative flag
+V_FLAG = 0x40       # Overflow flag
+U_FLAG = 0x20       # Has no effect - always 1
+B_FLAG = 0x10       # Break flag
+D_FLAG = 0x08       # Decimal mode
+I_FLAG = 0x04       # IRQ interrupt disable
+Z_FLAG = 0x02       # Zero flag
+C_FLAG = 0x01       # Carry flag
+
+# Number of times run() executes an instruction in writable memory before it
+# compiles the code from there into a block
+HOT_THRESHOLD = 50
+
+# Look up tables for binary-coded decimal (BCD), used in decimal mode. Any byte
+# can be decoded (bad digits above 9 just carry on counting), and any number
+# from 0 to 99 encoded
+_FROM_BCD = bytes((v >> 4)*10 + (v & 0xf) for v in range(0x100))
+_TO_BCD = bytes(((v // 10) << 4) | (v % 10) for v in range(100))
+
+# Look up table for the zero and negative flags that go with each 8 bit result
+_ZN_FLAGS = bytes((Z_FLAG if v == 0 else 0) | (v & N_FLAG) for v in range(0x100))
+
+# Look up table for the signed value of a byte in two's complement, used for
+# relative branches
+_TWOS_COMP = tuple((v & 0x7f) - (v & 0x80) for v in range(0x100))
 
 
 class Registers:
     '''
     An object for holding all the information about the 6502 CPU registers
     '''
+    # Registers are a fixed set, so store them in slots rather than a
+    # per-instance dictionary
+    __slots__ = ('a', 'x', 'y', 'sp', 'pc', '_p', '_zn')
+
+    # Look up for status flag masks by name
+    flagbyte = {
+        'N': N_FLAG,
+        'V': V_FLAG,
+        '?': U_FLAG,
+        'B': B_FLAG,
+        'D': D_FLAG,
+        'I': I_FLAG,
+        'Z': Z_FLAG,
+        'C': C_FLAG,
+    }
+
     def __init__(self, program_counter: int = 0) -> None:
         '''
         Initialise the registers by performing a reset.
         '''
-        # Define values for status flag register
-        self.flagbyte = {
-            'N': 128,       # Negative flat
-            'V': 64,        # Overflow flag
-            '?': 32,        # Has no effect - always 1
-            'B': 16,        # Break flag
-            'D': 8,         # Decimal mode
-            'I': 4,         # IRQ interrupt disable
-            'Z': 2,         # Zero flag
-            'C': 1,         # Carry flag
-        }
         # Reset register
         self.reset(program_counter)
 
@@ -58,46 +93,79 @@ class Registers:
         self.pc = program_counter
 
         # Set status flag register
-        self.p = self.flagbyte['?'] | self.flagbyte['I']
+        self.p = U_FLAG | I_FLAG
 
-    def get_flag(self, flag: str) -> bool:
+    def get_flag(self, flag: Union[str, int]) -> bool:
         '''
         Return a boolean that describes the state of the flag in the status
-        register.
+        register. Flag can be given by name (e.g. 'C') or by mask (C_FLAG).
+        Instructions test the mask against p directly - this is for callers
+        outside the processor.
         '''
-        return bool(self.p & self.flagbyte[flag])
+        if isinstance(flag, str):
+            flag = self.flagbyte[flag]
+        return bool(self.p & flag)
 
-    def set_flag(self, flag: str, value: bool = True) -> None:
+    def set_flag(self, flag: Union[str, int], value: bool = True) -> None:
         '''
-        Set particular flag to a value (either True or False)
+        Set particular flag to a value (either True or False). Flag can be
+        given by name (e.g. 'C') or by mask (C_FLAG). Instructions update p
+        directly - this is for callers outside the processor.
         '''
+        if isinstance(flag, str):
+            flag = self.flagbyte[flag]
+
         if value:
             # Set bit on
-            self.p = self.p | self.flagbyte[flag]
+            self.p = self.p | flag
         else:
-            # Flip bits of flagbyte so we can set flag to zero, but keep
+            # Flip bits of mask so we can set flag to zero, but keep
             # everything else - 00001000 -> 11110111
-            invert = 0xff - self.flagbyte[flag]
+            invert = 0xff ^ flag
             # And status register and inverted mask to set flag to False
             self.p = self.p & invert
 
+    @property
+    def p(self) -> int:
+        '''
+        Process status register. The zero and negative flags are not worked
+        out when an instruction sets them with ZN - only the result is kept,
+        and they are updated from it the next time the register is read.
+        Instructions in Processor set the result in _zn directly, to save a
+        call.
+        '''
+        result = self._zn
+        if result is not None:
+            # Zero flag is set if value is zero. Using twos-complement, number
+            # is negative if MSB is set. Clear both with mask 01111101 first
+            self._p = (self._p & 0x7d) | _ZN_FLAGS[result]
+            self._zn = None
+        return self._p
+
+    @p.setter
+    def p(self, value: int) -> None:
+        '''
+        Set the whole process status register, replacing any pending result
+        for the zero and negative flags
+        '''
+        self._p = value
+        self._zn = None
+
     def ZN(self, value: int) -> None:
         '''
         Zero and Negative flag often get set together and have standard
-        criteria. Function to conveniently set both together
+        criteria. Only a few instructions ever look at them, so rather than
+        set both straight away, keep hold of the value they depend on until
+        the status register is next read
         '''
-        # Zero flag is set if value is zero
-        self.set_flag('Z', value == 0)
-
-        # Using twos-complement, number is negative if MSB is set
-        self.set_flag('N', value & 0x80)
+        self._zn = value
 
     def clear_flags(self) -> None:
         '''
         Clears all the flags in the process status register
         '''
-        # Bit 6 is always on - but set all others to off
-        self.p = self.flagbyte['?']
+        # Bit 5 is always on - but set all others to off
+        self.p = U_FLAG
 
 
 class Processor:
@@ -113,11 +181,20 @@ class Processor:
         Normally, program counter does not need to be set. If left as None,
         the CPU will get the program start from reset vector $FFFD and $FFFC.
         '''
-        # Assign memory to CPU
+        # Assign memory to CPU. Reads go straight to the MMU's memory array
+        # rather than through a method call, as they can never fail
         self.mmu = memory_mgt_unit
+        self._mem = memory_mgt_unit.memory
+
+        # Mask of read-only addresses. Writes check it directly rather than
+        # going through the MMU, and instructions held in read-only memory
+        # can't change, so only need decoding once
+        self._read_only = memory_mgt_unit._read_only
 
-        # Initialise registers and set stack page
+        # Initialise registers and set stack page. Stack addresses are the
+        # stack pointer within this page, so keep the address it starts at
         self.stack_page = stack_page
+        self._stack_base = stack_page << 8
 
         # Define hard-coded addresses for interrupts
         self.interrupts = {'ABORT': 0xfff8,
@@ -127,6 +204,10 @@ class Processor:
                            'NMI':   0xfffa,
                            'RESET': 0xfffc}
 
+        # Optional function to trace execution - if set, it is called with the
+        # name of each instruction and the value passed to it, e.g. print
+        self.trace = None
+
         # Count number of cycles
         self.cycles = 0
 
@@ -138,20 +219,11 @@ class Processor:
             # Initialise registers with defined start point for pc
             self.r = Registers(program_counter)
         else:
-            # Initialise registers and initialise value for pc from reset
-            # vector in mmu
-            reset_vec = self.interrupts['RESET']
-            self.r = Registers(reset_vec)
-
-            # Read in address from reset vector
-            low_addr = self.read_byte()
-            high_addr = self.read_byte()
-            addr = (high_addr << 8) + low_addr
+            # Initialise registers and set pc to the address held in the reset
+            # vector in mmu - ready to execute. Reading it takes 2 cycles
+            self.r = Registers(self.interrupt_address('RESET'))
             self.cycles += 2
 
-            # Set program counter to this address - ready to execute
-            self.r.pc = addr
-
         # Now define dictionary to hold each op-code. Value for each key is a
         # 4-tuple of (name string, function to call, addressing mode, #cycles)
         self._ops = {
@@ -180,24 +252,24 @@ class Processor:
                      0x0e: ('ASL A', self.ASL, self._load_addr, 6),
                      0x1e: ('ASL A,x', self.ASL, self._load_addr_x, 7),
                      # Bxx - Branching instructions
-                     0x10: ('BPL', self.BRA, ('N', False), 2),
-                     0x30: ('BMI', self.BRA, ('N', True), 2),
-                     0x50: ('BVC', self.BRA, ('V', False), 2),
-                     0x70: ('BVS', self.BRA, ('V', True), 2),
-                     0x90: ('BCC', self.BRA, ('C', False), 2),
-                     0xb0: ('BCS', self.BRA, ('C', True), 2),
-                     0xd0: ('BNE', self.BRA, ('Z', False), 2),
-                     0xf0: ('BEQ', self.BRA, ('Z', True), 2),
+                     0x10: ('BPL', self.BPL, self._relative, 2),
+                     0x30: ('BMI', self.BMI, self._relative, 2),
+                     0x50: ('BVC', self.BVC, self._relative, 2),
+                     0x70: ('BVS', self.BVS, self._relative, 2),
+                     0x90: ('BCC', self.BCC, self._relative, 2),
+                     0xb0: ('BCS', self.BCS, self._relative, 2),
+                     0xd0: ('BNE', self.BNE, self._relative, 2),
+                     0xf0: ('BEQ', self.BEQ, self._relative, 2),
                      # BIT - Bit test
                      0x24: ('BIT Z', self.BIT, self._zero_page_value, 3),
                      0x2c: ('BIT A', self.BIT, self._load_addr_value, 4),
                      # BRK - Break Command
                      0x00: ('BRK', self.BRK, self._implied, 7),
                      # CLx - Clear Flag
-                     0x18: ('CLC', self.CLR, 'C', 2),
-                     0xd8: ('CLD', self.CLR, 'D', 2),
-                     0x58: ('CLI', self.CLR, 'I', 2),
-                     0xb8: ('CLV', self.CLR, 'V', 2),
+                     0x18: ('CLC', self.CLR, C_FLAG, 2),
+                     0xd8: ('CLD', self.CLR, D_FLAG, 2),
+                     0x58: ('CLI', self.CLR, I_FLAG, 2),
+                     0xb8: ('CLV', self.CLR, V_FLAG, 2),
                      # CMP - Compare with accumulator
                      0xc9: ('CMP Im', self.CMP, self._load_im, 2),
                      0xc5: ('CMP Z', self.CMP, self._zero_page_value, 3),
@@ -286,11 +358,11 @@ class Processor:
                      0x01: ('ORA I,x', self.ORA, self._load_ix_value, 6),
                      0x11: ('ORA I,y', self.ORA, self._load_iy_value, 5),
                      # PHx - Push onto the stack - accumulator or status reg
-                     0x48: ('PHA', self.PHS, self.r.a, 3),
-                     0x08: ('PHP', self.PHS, self.r.p, 3),
+                     0x48: ('PHA', self.PHA, self._implied, 3),
+                     0x08: ('PHP', self.PHP, self._implied, 3),
                      # PLx - Pull from stack - accumulator or status reg
-                     0x68: ('PLA', self.PLS, 'a', 4),
-                     0x28: ('PLP', self.PLS, 'p', 4),
+                     0x68: ('PLA', self.PLA, self._implied, 4),
+                     0x28: ('PLP', self.PLP, self._implied, 4),
                      # ROL - Rotate left
                      0x2a: ('ROL Im', self.ROL, 'a', 2),
                      0x26: ('ROL Z', self.ROL, self._zero_page, 5),
@@ -308,9 +380,9 @@ class Processor:
                      # RTS - Return from subroutine
                      0x60: ('RTS', self.RTS, self._implied, 6),
                      # SEx - Set Flag
-                     0x38: ('SEC', self.SET, 'C', 2),
-                     0xf8: ('SED', self.SET, 'D', 2),
-                     0x78: ('SEI', self.SET, 'I', 2),
+                     0x38: ('SEC', self.SET, C_FLAG, 2),
+                     0xf8: ('SED', self.SET, D_FLAG, 2),
+                     0x78: ('SEI', self.SET, I_FLAG, 2),
                      # SBC - Subtract with carry
                      0xe9: ('SBC Im', self.SBC, self._load_im, 2),
                      0xe5: ('SBC Z', self.SBC, self._zero_page_value, 3),
@@ -337,22 +409,106 @@ class Processor:
                      0x94: ('STY Z,x', self.STY, self._zero_page_x, 4),
                      0x8c: ('STY A', self.STY, self._load_addr, 4),
                      # Tab - Transfer from a to b
-                     0xaa: ('TAX', self.TRA, ('a', 'x'), 2),
-                     0x8a: ('TXA', self.TRA, ('x', 'a'), 2),
-                     0xa8: ('TAY', self.TRA, ('a', 'y'), 2),
-                     0x98: ('TYA', self.TRA, ('y', 'a'), 2),
-                     0x9a: ('TXS', self.TRA, ('x', 's'), 2),
-                     0xba: ('TSX', self.TRA, ('s', 'a'), 2)
+                     0xaa: ('TAX', self.TAX, self._implied, 2),
+                     0x8a: ('TXA', self.TXA, self._implied, 2),
+                     0xa8: ('TAY', self.TAY, self._implied, 2),
+                     0x98: ('TYA', self.TYA, self._implied, 2),
+                     0x9a: ('TXS', self.TXS, self._implied, 2),
+                     0xba: ('TSX', self.TSX, self._implied, 2)
                      }
 
+        # Opcodes are a single byte, so lay the table out as a list with a slot
+        # for every possible opcode, None if it is not a valid instruction.
+        # Indexing this is cheaper than hashing the opcode into the dictionary
+        self._op_table = 0x100*[None]
+        for opcode, op in self._ops.items():
+            self._op_table[opcode] = op
+
+        # Number of operand bytes that follow the opcode for each addressing
+        # mode. Instructions with a fixed argument have no operand.
+        self._operand_bytes = {self._load_im: 1,
+                               self._zero_page: 1,
+                               self._zero_page_value: 1,
+                               self._zero_page_x: 1,
+                               self._zero_page_x_value: 1,
+                               self._zero_page_y: 1,
+                               self._zero_page_y_value: 1,
+                               self._load_addr: 2,
+                               self._load_addr_value: 2,
+                               self._load_addr_x: 2,
+                               self._load_addr_x_value: 2,
+                               self._load_addr_y: 2,
+                               self._load_addr_y_value: 2,
+                               self._load_ix: 1,
+                               self._load_ix_value: 1,
+                               self._load_iy: 1,
+                               self._load_iy_value: 1,
+                               self._load_indirect: 2,
+                               self._relative: 1,
+                               self._implied: 0}
+
+        # Addressing modes that only depend on the operand itself, not on the
+        # registers or memory, so can be resolved once at decode time
+        self._static_modes = {self._load_im, self._zero_page, self._load_addr,
+                              self._implied}
+
+        # Handler function for each opcode, which fetches, decodes and executes
+        # the instruction in one call (see codegen.compile_handler). Used for
+        # instructions that have not been predecoded
+        self._handlers = compile_handlers(self)
+
+        # Whether each opcode changes the flow of the programme, so a block
+        # could start at whatever runs after it
+        self._ends_block = [op is not None and op[1].__name__ in BLOCK_END
+                            for op in self._op_table]
+
+        # The tables of decoded instructions and compiled blocks below are
+        # only made the first time they are used (see __getattr__):
+        #
+        # _decoded - pre-decoded instructions, indexed by the address they
+        # start at. Only instructions in read-only memory are kept, either
+        # decoded ahead of time by predecode, or the first time they are run.
+        # Each entry is a 6-tuple of (name string, function to call,
+        # addressing mode or None if already resolved, operand, #cycles,
+        # next pc)
+        #
+        # _blocks - compiled blocks of predecoded instructions, indexed by the
+        # address they start at. Each entry is a 3-tuple of (function,
+        # #instructions, end address)
+        #
+        # _ram_blocks - compiled blocks of code in writable memory, only made
+        # once it has been run HOT_THRESHOLD times (counted in _ram_counts,
+        # only where a block could start - see run). Each entry is a 4-tuple
+        # of (function, #instructions, end address, bytes of code it was
+        # compiled from), as the code needs checking before each run
+
+    def __getattr__(self, name: str):
+        '''
+        Makes the tables of decoded instructions and compiled blocks the first
+        time each is used. They have an entry for every address, so are slow
+        to make compared to the rest of the processor, and not every
+        processor needs them all. Only called for attributes that haven't
+        been set, so costs nothing once a table is made
+        '''
+        if name in ('_decoded', '_blocks', '_ram_blocks'):
+            table = 0x10000*[None]
+        elif name == '_ram_counts':
+            table = 0x10000*[0]
+        else:
+            raise AttributeError(f'{type(self).__name__!r} object has no '
+                                 f'attribute {name!r}')
+        setattr(self, name, table)
+        return table
+
     def read_byte(self) -> int:
         '''
         Read byte from address that program counter is currently set to
         '''
-        value = self.mmu.read(self.r.pc)
+        r = self.r
+        value = self._mem[r.pc]
 
-        # Increment program counter and cycles
-        self.r.pc += 1
+        # Increment program counter, wrapping round at the top of memory
+        r.pc = (r.pc + 1) & 0xffff
         return value
 
     def read_word(self) -> int:
@@ -365,30 +521,195 @@ class Processor:
         value = (high_byte << 8) + low_byte
         return value
 
-    def step(self) -> None:
+    def decode(self, addr: int) -> tuple:
         '''
-        Steps through to the next instruction - fetches it from memory, decodes
-        instruction and executes.
+        Decodes the instruction starting at addr, reading in its operand and
+        resolving the addressing mode where it does not depend on the state
+        of the CPU. Returns a 6-tuple of (name string, function to call,
+        addressing mode or None, operand, #cycles, next pc).
         '''
-        # Fetch instruction
-        opcode = self.read_byte()
-
-        # Decode instruction
-        try:
-            name, instruction, argument, cycles = self._ops[opcode]
-        except KeyError:
+        opcode = self._mem[addr]
+        op = self._op_table[opcode]
+        if op is None:
             raise InvalidInstructionError(f'{opcode} is not a valid instruction')
+        name, instruction, argument, cycles = op
 
         # Check to see whether argument in function or fixed value
-        try:
-            # Call function to load argument to operation
-            additional_value = argument()
-        except TypeError:
-            # The argument is a fixed value rather than function
-            additional_value = argument
+        if not callable(argument):
+            # Fixed value is passed straight through to the instruction
+            return (name, instruction, None, argument, cycles,
+                    (addr + 1) & 0xffff)
+
+        # Read in operand bytes following the opcode
+        length = self._operand_bytes[argument]
+        if length == 0:
+            operand = None
+        elif length == 1:
+            operand = self._mem[(addr + 1) & 0xffff]
+        else:
+            operand = (self._mem[(addr + 2) & 0xffff] << 8) + \
+                self._mem[(addr + 1) & 0xffff]
+
+        if argument in self._static_modes:
+            # Operand is the value passed to the instruction
+            argument = None
+
+        return (name, instruction, argument, operand, cycles,
+                (addr + 1 + length) & 0xffff)
+
+    def predecode(self, start_addr: int, length: int) -> None:
+        '''
+        Decodes every instruction in a read-only block of memory (i.e. ROM)
+        ahead of time, so that executing them does not need to fetch and decode
+        the instruction again. Addresses that are writable, or do not hold a
+        valid instruction, are left to be decoded when they are executed.
+        '''
+        for addr in range(start_addr, start_addr + length):
+            try:
+                decoded = self.decode(addr)
+            except InvalidInstructionError:
+                continue
+
+            if self._in_read_only(addr, decoded):
+                self._decoded[addr] = decoded
+
+    def decode_ahead(self, start_addr: int) -> Union[None, tuple]:
+        '''
+        Decodes the instructions in read-only memory from start_addr in the
+        order they would run, and keeps them so they do not need decoding
+        again. Stops after an instruction that changes the flow of the
+        programme, or at one that has already been decoded, is invalid or is
+        not held entirely in read-only memory. Returns the decoded instruction
+        at start_addr, or None if it could not be kept.
+        '''
+        decoded_ops = self._decoded
+        addr = start_addr
+        while decoded_ops[addr] is None:
+            try:
+                decoded = self.decode(addr)
+            except InvalidInstructionError:
+                if addr == start_addr:
+                    raise
+                break
+
+            if not self._in_read_only(addr, decoded):
+                break
+
+            decoded_ops[addr] = decoded
+            if decoded[1].__name__ in BLOCK_END:
+                break
+            addr = decoded[5]
+
+        return decoded_ops[start_addr]
+
+    def compile_rom(self, start_addr: int, length: int) -> int:
+        '''
+        Compiles the programme held in a block of ROM ahead of time, so it runs
+        as straight-line Python code from the start (see
+        codegen.compile_block). The programme is followed from its entry
+        points (start_addr, the program counter and the interrupt vectors)
+        through every branch, jump and subroutine call, decoding (see
+        decode_ahead) and compiling a block at the start of each run of
+        instructions found, so only code that can be reached is decoded.
+        Code only reached indirectly (e.g. via JMP Ind or RTS into the middle
+        of a block) is still compiled the first time it is run. Returns the
+        number of blocks compiled.
+        '''
+        end_addr = start_addr + length
+
+        entries = [start_addr, self.r.pc]
+        entries += [self.interrupt_address(i) for i in self.interrupts]
+        todo = [addr for addr in entries if start_addr <= addr < end_addr]
+
+        compiled = 0
+        while todo:
+            addr = todo.pop()
+            if self._blocks[addr] is not None:
+                continue
+            try:
+                self.decode_ahead(addr)
+            except InvalidInstructionError:
+                continue
+            block = compile_block(self, addr)
+            if block is None:
+                continue
+            self._blocks[addr] = block
+            compiled += 1
+
+            # Find the last instruction in the block, to see where the
+            # programme can go next
+            for _ in range(block[1]):
+                name, instruction, argument, operand, cycles, next_pc = \
+                    self._decoded[addr]
+                addr = next_pc
+
+            following = []
+            if argument == self._relative:
+                # Branch can go either way
+                following += [self._relative_target(next_pc, operand),
+                              next_pc]
+            elif instruction == self.JSR:
+                # Subroutine returns to the next instruction
+                following += [operand, next_pc]
+            elif instruction == self.JMP:
+                if argument is None:
+                    following += [operand]
+            elif instruction not in (self.BRK, self.RTI, self.RTS):
+                # Block just got too long - carry on
+                following += [next_pc]
+
+            todo += [addr for addr in following
+                     if start_addr <= addr < end_addr]
+
+        return compiled
+
+    def _compile_ram_block(self, addr: int) -> Union[None, tuple]:
+        '''
+        Compiles the code in writable memory at addr into a block (see
+        codegen.compile_ram_block), keeping a copy of the code it came from
+        '''
+        block = compile_ram_block(self, addr)
+        if block is None:
+            return None
+        func, count, end_addr = block
+        return func, count, end_addr, bytes(self._mem[addr:end_addr])
+
+    def _in_read_only(self, addr: int, decoded: tuple) -> bool:
+        '''
+        Checks whether all the bytes of the decoded instruction at addr are in
+        read-only memory - only then is it safe to keep
+        '''
+        size = (decoded[5] - addr) & 0xffff
+        return all(self._read_only[(addr + i) & 0xffff] for i in range(size))
 
-        # Print commands
-        print(f'{name}\t{additional_value}')
+    def step(self) -> None:
+        '''
+        Steps through to the next instruction - fetches it from memory, decodes
+        instruction and executes.
+        '''
+        # Fetch and decode instruction. If it hasn't been decoded already, and
+        # can't be kept, its opcode's handler does everything (unless tracing)
+        pc = self.r.pc
+        decoded = self._decoded[pc]
+        if decoded is None and self._read_only[pc]:
+            decoded = self.decode_ahead(pc)
+        if decoded is None:
+            if self.trace is None:
+                self._handlers[self._mem[pc]](self)
+                return
+            decoded = self.decode(pc)
+        name, instruction, argument, operand, cycles, next_pc = decoded
+        self.r.pc = next_pc
+
+        # Check to see whether argument still needs to be loaded
+        if argument is None:
+            additional_value = operand
+        else:
+            additional_value = argument(operand)
+
+        # Trace commands
+        if self.trace is not None:
+            self.trace(name, additional_value)
 
         # Execute
         instruction(additional_value)
@@ -396,19 +717,145 @@ class Processor:
         # Count number of cycles
         self.cycles += cycles
 
+    def run(self, n_steps: int, stop_pc: int = None) -> int:
+        '''
+        Executes the next n_steps instructions in a single batch, rather than
+        having the caller drive step() from its own Python loop. If stop_pc is
+        given, stops early when the program counter reaches it, without running
+        the instruction there. Returns the number of instructions executed.
+
+        Instructions in read-only memory are decoded (see decode_ahead) the
+        first time they are run and, unless execution is being traced,
+        compiled into blocks (see codegen.compile_block), which are then run
+        whole in one call.
+
+        Instructions in writable memory are run by their opcode's handler
+        until they have been run HOT_THRESHOLD times, then the code from there
+        is compiled into a block too (see codegen.compile_ram_block). Only
+        addresses straight after an instruction that changes the flow of the
+        programme are counted, as only they can start a block. That code
+        could change, so its block is only run while the code still matches
+        what it was compiled from.
+
+        Anything else is interpreted one instruction at a time: the body of
+        step() is inlined into the loop, with the registers and decoded
+        instructions held in local variables, so there is no method call or
+        attribute lookup chain per instruction for dispatch. Any change to
+        step() must be mirrored here.
+        '''
+        r = self.r
+        decoded_ops = self._decoded
+        blocks = self._blocks
+        ram_blocks = self._ram_blocks
+        ram_counts = self._ram_counts
+        handlers = self._handlers
+        ends_block = self._ends_block
+        mem = self._mem
+        read_only = self._read_only
+        decode = self.decode
+        decode_ahead = self.decode_ahead
+        trace = self.trace
+        remaining = n_steps
+
+        # Block being stepped through one instruction at a time, as it
+        # doesn't fit or runs past stop_pc - no new blocks are compiled for
+        # the instructions inside it, as they would never be run either
+        skip_start = skip_end = 0
+
+        # Whether a block of code in writable memory could start at pc
+        block_start = True
+
+        while remaining > 0:
+            pc = r.pc
+            if pc == stop_pc:
+                break
+
+            # Run a whole compiled block if there is one, it fits, and it
+            # doesn't run past where we have been asked to stop
+            block = blocks[pc]
+            if block is None:
+                decoded = decoded_ops[pc]
+                if decoded is None and read_only[pc]:
+                    decoded = decode_ahead(pc)
+                if decoded is not None and trace is None and \
+                        not skip_start < pc < skip_end:
+                    block = blocks[pc] = compile_block(self, pc)
+            if block is not None and trace is None:
+                if block[1] <= remaining and \
+                        (stop_pc is None or not pc < stop_pc < block[2]):
+                    remaining -= block[0](self)
+                    block_start = True
+                    continue
+                skip_start, skip_end = pc, block[2]
+
+            # Fetch and decode instruction
+            decoded = decoded_ops[pc]
+            if decoded is None:
+                if trace is None:
+                    # Code in writable memory - run it as a block if it is hot
+                    # and unchanged, otherwise count towards compiling it
+                    block = ram_blocks[pc]
+                    if block is None:
+                        if block_start:
+                            ram_counts[pc] += 1
+                            if ram_counts[pc] == HOT_THRESHOLD:
+                                ram_blocks[pc] = self._compile_ram_block(pc)
+                    elif mem[pc:block[2]] != block[3]:
+                        # Code has changed - start counting again
+                        ram_blocks[pc] = None
+                        ram_counts[pc] = 0
+                    elif block[1] <= remaining and \
+                            (stop_pc is None or not pc < stop_pc < block[2]):
+                        # Block may leave early if it writes over its own code
+                        remaining -= block[0](self)
+                        block_start = True
+                        continue
+
+                    opcode = mem[pc]
+                    handlers[opcode](self)
+                    block_start = ends_block[opcode]
+                    remaining -= 1
+                    continue
+                decoded = decode(pc)
+            name, instruction, argument, operand, cycles, r.pc = decoded
+
+            # Check to see whether argument still needs to be loaded
+            if argument is None:
+                additional_value = operand
+            else:
+                additional_value = argument(operand)
+
+            # Trace commands
+            if trace is not None:
+                trace(name, additional_value)
+
+            # Execute and count number of cycles
+            instruction(additional_value)
+            self.cycles += cycles
+            block_start = True
+            remaining -= 1
+
+        return n_steps - remaining
+
+    def run_until(self, stop_pc: int, max_steps: int = 1_000_000) -> int:
+        '''
+        Runs until the program counter reaches stop_pc (e.g. the address of
+        the loop a program finishes in), or until max_steps instructions have
+        been executed. Returns the number of instructions executed.
+        '''
+        return self.run(max_steps, stop_pc)
+
     def stack_pull(self) -> int:
         '''
         Pull value from stack
         '''
-        # Get stack address
-        addr = self.stack_page*0x100 + ((self.r.sp + 1) & 0xff)
+        # Stack pointer points at the next free slot, so the top of the stack
+        # is the one above it
+        r = self.r
+        r.sp = (r.sp + 1) & 0xff
 
         # Read from stack
-        value = self.mmu.read(addr)
-
-        # Increment stack pointer
-        self.r.sp = (self.r.sp + 1) & 0xff
-        return value
+        return self._mem[self._stack_base | r.sp]
 
     def stack_pull_word(self) -> int:
         '''
@@ -420,14 +867,17 @@ class Processor:
         '''
         Push value onto stack
         '''
-        # Get stack address
-        addr = self.stack_page*0x100 + ((self.r.sp + 1) & 0xff)
+        # Stack pointer points at the next free slot
+        r = self.r
+        addr = self._stack_base | r.sp
 
         # Write value to stack
-        self.mmu.write(addr, value)
+        if self._read_only[addr]:
+            raise ReadOnlyError()
+        self._mem[addr] = value
 
         # Decrement stack pointer
-        self.r.sp = (self.r.sp - 1) & 0xff
+        r.sp = (r.sp - 1) & 0xff
 
     def stack_push_word(self, value: int) -> None:
         '''
@@ -442,8 +892,8 @@ class Processor:
         '''
         # Need to read word from location given by interrupt
         interrupt_addr = self.interrupts[interrupt]
-        high_byte = self.mmu.read(interrupt_addr+1)
-        low_byte = self.mmu.read(interrupt_addr)
+        high_byte = self._mem[interrupt_addr+1]
+        low_byte = self._mem[interrupt_addr]
         value = (high_byte << 8) + low_byte
         return value
 
@@ -451,237 +901,244 @@ class Processor:
         '''
         Convert number from binary-coded decimal (BCD)
         '''
-        return (((value & 0xf0) // 0x10) * 10) + (value & 0xf)
+        return _FROM_BCD[value]
 
     def to_BCD(self, value: int) -> int:
         '''
-        Converts number to BCD
+        Converts number (0 to 99) to BCD
         '''
-        return int(math.floor(value/10))*16 + (value % 10)
+        return _TO_BCD[value]
 
     def from_twos_comp(self, value: int) -> int:
         '''
         Gets number from twos complement
         '''
-        return (value & 0x7f) - (value & 0x80)
+        return _TWOS_COMP[value]
 
     # ------ Addressing Modes ------ #
-    def _load_im(self) -> int:
+    # Each addressing mode is given the operand that follows the opcode (the
+    # byte or little-endian word already read in by decode), and returns the
+    # additional parameter to pass to the instruction.
+    def _load_im(self, operand: int) -> int:
         '''
         Load immediate: Next value in the program is the value to pass to the
         instruction as an additional parameter
         '''
-        # Read value
-        value = self.read_byte()
-        return value
+        return operand
 
-    def _zero_page(self) -> int:
+    def _zero_page(self, operand: int) -> int:
         '''
         Loads in address from zero page memory location
         '''
-        zero_page_addr = self.read_byte()
-        return zero_page_addr
+        return operand
 
-    def _zero_page_value(self) -> int:
+    def _zero_page_value(self, operand: int) -> int:
         '''
         Returns value from address given by zero page memory location
         '''
-        addr = self._zero_page()
-        value = self.mmu.read(addr)
+        addr = self._zero_page(operand)
+        value = self._mem[addr]
         return value
 
-    def _zero_page_x(self) -> int:
+    def _zero_page_x(self, operand: int) -> int:
         '''
         Loads in address from zero page memory location shifted by the current
         value in the x register
         '''
-        zero_page_addr = self.read_byte()
-
-        # Read in x register - incrementing pc
+        # Read in x register
         offset = self.r.x
 
-        zero_page_addr = (zero_page_addr + offset) & 0xff
+        zero_page_addr = (operand + offset) & 0xff
         return zero_page_addr
 
-    def _zero_page_x_value(self) -> int:
+    def _zero_page_x_value(self, operand: int) -> int:
         '''
         Loads in value from zero page memory location shifted by the current
         value in the x register
         '''
-        addr = self._zero_page_x()
-        value = self.mmu.read(addr)
+        addr = self._zero_page_x(operand)
+        value = self._mem[addr]
         return value
 
-    def _zero_page_y(self) -> int:
+    def _zero_page_y(self, operand: int) -> int:
         '''
         Loads in address from zero page memory location shifted by the current
         value in the x register
         '''
-        zero_page_addr = self.read_byte()
-
-        # Read in x register - incrementing pc
+        # Read in y register
         offset = self.r.y
 
-        zero_page_addr = (zero_page_addr + offset) & 0xff
+        zero_page_addr = (operand + offset) & 0xff
         return zero_page_addr
 
-    def _zero_page_y_value(self) -> int:
+    def _zero_page_y_value(self, operand: int) -> int:
         '''
         Loads in value from zero page memory location shifted by the current
         value in the x register
         '''
-        addr = self._zero_page_y()
-        value = self.mmu.read(addr)
+        addr = self._zero_page_y(operand)
+        value = self._mem[addr]
         return value
 
-    def _load_addr(self) -> int:
+    def _load_addr(self, operand: int) -> int:
         '''
         Loads address from full 16 bit address
         '''
-        addr = self.read_word()
-        return addr
+        return operand
 
-    def _load_addr_value(self) -> int:
+    def _load_addr_value(self, operand: int) -> int:
         '''
         Loads value from full 16 bit address
         '''
-        addr = self._load_addr()
-        value = self.mmu.read(addr)
+        addr = self._load_addr(operand)
+        value = self._mem[addr]
         return value
 
-    def _load_addr_x(self) -> int:
+    def _load_addr_x(self, operand: int) -> int:
         '''
         Loads in address from full memory location shifted by the current
         value in the x register
         '''
-        addr = self.read_word()
+        addr = operand
 
-        # Read in x register - incrementing pc
+        # Read in x register
         offset = self.r.x
 
         final_addr = (addr + offset) & 0xffff
 
-        # Add extra cycle if cross page boundary
-        if math.floor(addr/0xff) != math.floor(final_addr/0xff):
-            self.cycles += 1
+        # Add extra cycle if cross page boundary - adding the offset to the
+        # low byte carries into bit 8 exactly when it does
+        self.cycles += ((addr & 0xff) + offset) >> 8
 
         return final_addr
 
-    def _load_addr_x_value(self) -> int:
+    def _load_addr_x_value(self, operand: int) -> int:
         '''
         Loads in value from full memory location shifted by the current
         value in the x register
         '''
-        addr = self._load_addr_x()
-        value = self.mmu.read(addr)
+        addr = self._load_addr_x(operand)
+        value = self._mem[addr]
         return value
 
-    def _load_addr_y(self) -> int:
+    def _load_addr_y(self, operand: int) -> int:
         '''
         Loads in address from full memory location shifted by the current
-        value in the x register
+        value in the y register
         '''
-        addr = self.read_word()
+        addr = operand
 
-        # Read in x register - incrementing pc
-        offset = self.r.x
+        # Read in y register
+        offset = self.r.y
 
         final_addr = (addr + offset) & 0xffff
 
-        # Add extra cycle if cross page boundary
-        if math.floor(addr/0xff) != math.floor(final_addr/0xff):
-            self.cycles += 1
+        # Add extra cycle if cross page boundary - adding the offset to the
+        # low byte carries into bit 8 exactly when it does
+        self.cycles += ((addr & 0xff) + offset) >> 8
 
         return final_addr
 
-    def _load_addr_y_value(self) -> int:
+    def _load_addr_y_value(self, operand: int) -> int:
         '''
         Loads in value from full memory location shifted by the current
-        value in the x register
+        value in the y register
         '''
-        addr = self._load_addr_y()
-        value = self.mmu.read(addr)
+        addr = self._load_addr_y(operand)
+        value = self._mem[addr]
         return value
 
-    def _load_ix(self) -> int:
+    def _load_ix(self, operand: int) -> int:
         '''
         Indirect loading using value in the x register to find address that
         should be read. A byte is read and added to the contents of the x
         register. This defines a zero-page memory address, which can be read
         to find the location of the data required.
         '''
-        # Load in value in next byte and add contents of x register
-        intermed = (self.read_byte() + self.r.x) & 0xff
+        # Add contents of x register to operand
+        intermed = (operand + self.r.x) & 0xff
 
         # Now we have address to go to in order to find address to read value
         # from to send as additional parameter
-        high_byte = self.mmu.read((intermed+1) & 0xff)
-        low_byte = self.mmu.read(intermed)
+        high_byte = self._mem[(intermed+1) & 0xff]
+        low_byte = self._mem[intermed]
         addr = ((high_byte << 8) + low_byte) & 0xffff
 
         return addr
 
-    def _load_ix_value(self) -> int:
+    def _load_ix_value(self, operand: int) -> int:
         '''
         Indirect loading using value in the x register to find address that
         should be read. A byte is read and added to the contents of the x
         register. This defines a zero-page memory address, which can be read
         to find the location of the data required.
         '''
-        addr = self._load_ix()
-        value = self.mmu.read(addr)
+        addr = self._load_ix(operand)
+        value = self._mem[addr]
         return value
 
-    def _load_iy(self) -> int:
+    def _load_iy(self, operand: int) -> int:
         '''
         Indirect loading using value in the y register. A byte is read to give
         the location in zero page memory to start reading an address. This
         address is added to the contents of the y register to give the final
         address. A value is loaded from this location.
         '''
-        # Read in value
-        intermed = self.read_byte()
+        intermed = operand
 
-        # Read in the memory location
-        high_byte = self.mmu.read(intermed+1) & 0xff
-        low_byte = self.mmu.read(intermed)
+        # Read in the memory location - the pointer wraps round in zero page
+        high_byte = self._mem[(intermed+1) & 0xff]
+        low_byte = self._mem[intermed]
         addr = (high_byte << 8) + low_byte
-        final_addr = addr + self.r.y
+        final_addr = (addr + self.r.y) & 0xffff
 
-        # Check to see if we have crossed page boundary - add extra cycle if so
-        if math.floor(addr/0xff) != math.floor(final_addr/0xff):
-            self.cycles += 1
+        # Add extra cycle if cross page boundary (see _load_addr_x)
+        self.cycles += (low_byte + self.r.y) >> 8
 
-        return addr
+        return final_addr
 
-    def _load_iy_value(self) -> int:
+    def _load_iy_value(self, operand: int) -> int:
         '''
         Indirect loading using value in the y register. A byte is read to give
         the location in zero page memory to start reading an address. This
         address is added to the contents of the y register to give the final
         address. A value is loaded from this location.
         '''
-        addr = self._load_iy()
-        value = self.mmu.read(addr)
+        addr = self._load_iy(operand)
+        value = self._mem[addr]
         return value
 
-    def _load_indirect(self) -> int:
+    def _load_indirect(self, operand: int) -> int:
         '''
         Indirect loading using value at given address. Only used by indirect
         JMP instruction. Also, doesn't carry, so if low byte is in xxFF
         position, the high byte will be xx00 rather than xy00'
         '''
-        addr1 = self.read_word()
+        addr1 = operand
         # Result doesn't carry
         if (addr1 & 0xff) == 0xff:
             addr2 = addr1 - 0xff
         else:
             addr2 = addr1 + 1
 
-        result = (self.mmu.read(addr2) << 8) + self.mmu.read(addr1)
+        result = (self._mem[addr2] << 8) + self._mem[addr1]
         return result & 0xffff
 
-    def _implied(self) -> None:
+    def _relative(self, operand: int) -> int:
+        '''
+        Relative addressing, used by the branch instructions. The operand is
+        a signed offset from the address of the next instruction, which gives
+        the address to branch to.
+        '''
+        return (self.r.pc + _TWOS_COMP[operand]) & 0xffff
+
+    def _relative_target(self, pc: int, operand: int) -> int:
+        '''
+        Address a branch goes to, given the address of the next instruction
+        '''
+        return (pc + _TWOS_COMP[operand]) & 0xffff
+
+    def _implied(self, operand: None) -> None:
         '''
         Implied addressing mode - no need to do anything
         '''
@@ -693,131 +1150,191 @@ class Processor:
         Add with carry. Adds (with carry) value2 to current contents of
         accumulator.
         '''
-        # Get current accumulator value
-        value1 = self.r.a
+        r = self.r
+        # Get current accumulator value and status register
+        value1 = r.a
+        p = r.p
 
         # Check to see if in decimal mode or binary mode
-        if self.r.get_flag('D'):
+        if p & D_FLAG:
             # Convert numbers from BCD
-            value1 = self.from_BCD(value1)
-            value2 = self.from_BCD(value2)
+            value1 = _FROM_BCD[value1]
+            value2 = _FROM_BCD[value2]
 
-            # Perform addition
-            result = value1 + value2 + self.r.get_flag('C')
-            self.r.a = self.to_BCD(result)
+            # Perform addition - only the last two decimal digits are kept
+            result = value1 + value2 + (p & C_FLAG)
+            r.a = _TO_BCD[result % 100]
 
-            # Set carry flag
-            self.r.set_flag('C', result > 99)
+            # Carry if result doesn't fit in two decimal digits
+            carry = result > 99
         else:
             # Perform addition
-            result = value1 + value2 + self.r.get_flag('C')
+            result = value1 + value2 + (p & C_FLAG)
 
             # Put result in 8 bit accumulator register
-            self.r.a = result & 0xff
+            r.a = result & 0xff
 
-            # Set carry flag if required
-            self.r.set_flag('C', result > 0xff)
+            # Carry if result doesn't fit in 8 bits
+            carry = result > 0xff
 
-        # Set zero and negative flags
-        self.r.ZN(self.r.a)
+        # Overflow if sign of result differs from that of both inputs
+        overflow = (~(value1 ^ value2)) & (value1 ^ result) & 0x80
 
-        # Set overflow flag
-        self.r.set_flag('V', ((~(value1 ^ value2)) & (value1 ^ result) & 0x80))
+        # Set carry (bit 0) and overflow (bit 6) flags in a single update,
+        # clearing both with mask 10111110 first
+        r.p = (p & 0xbe) | (overflow >> 1) | carry
+
+        # Set zero and negative flags
+        r._zn = r.a
 
     def AND(self, value2: int) -> None:
         '''
         And. Ands value2 with current contents of accumulator
         '''
-        # Perform AND Operation between acummulator and value2
-        calculation = self.r.a & value2
-
-        # Put result back into 8 bit acummulator
-        self.r.a = calculation & 0xff
-
-        # Set zero and negative flags
-        self.r.ZN(self.r.a)
+        # Perform AND Operation between acummulator and value2, and set zero
+        # and negative flags from the result
+        r = self.r
+        r.a = r._zn = r.a & value2
 
     def ASL(self, addr: int) -> None:
         '''
         ASL shifts all bits left one position. 0 is shifted into bit 0 and
         the original bit 7 is shifted into the Carry.
         '''
+        r = self.r
         if addr == 'a':
             # Shift contents of accumulator left
-            value = self.r.a << 1
-            self.r.a = value & 0xff
+            value = r.a << 1
+            r.a = value & 0xff
         else:
             # Shift acting on value in memory location
-            value = self.mmu.read(addr) << 1
-            self.mmu.write(addr, value)
+            mem = self._mem
+            value = mem[addr] << 1
+            if self._read_only[addr]:
+                raise ReadOnlyError()
+            mem[addr] = value & 0xff
 
-        # If shifted value is greater than 0xff, then original bit 7 was 1
-        self.r.set_flag('C', value > 0xff)
-        self.r.ZN(value & 0xff)
+        # Original bit 7 has been shifted into bit 8 - move it to the carry
+        r.p = (r.p & 0xfe) | (value >> 8)
+        r._zn = value & 0xff
 
-    def BRA(self, value2: int) -> None:
+    def BRA(self, value2: tuple[int, bool], addr: int) -> None:
         '''
         Handles all the branching operations. Value 2 is a tuple of
-        (flag, bool) that fully defines all branching operations. For example,
-        branch carry clear (BCC) would have value2 set to ('C', False)
+        (flag mask, bool) that fully defines the condition to branch on, and
+        addr is the address to branch to. For example, branch carry clear (BCC)
+        would have value2 set to (C_FLAG, False)
         '''
-        # Get relative address value
-        jump = self._load_im()
-
+        r = self.r
         flag, state = value2
         # Determine if we need to branch
-        if self.r.get_flag(flag) is state:
-            # Negative flag not set - calculate address to jump to
-            current_pc = self.r.pc
-            self.r.pc += self.from_twos_comp(jump)
-            if math.floor(current_pc/0xff) == math.floor(self.r.pc/0xff):
-                # Same page, only takes 1 clock cycle
-                self.cycles += 1
-            else:
-                # Different page, takes two clock cycles
-                self.cycles += 2
+        if bool(r.p & flag) is state:
+            # Condition met - jump to address
+            self.cycles += self._branch_cycles(r.pc, addr)
+            r.pc = addr
+
+    def _branch_cycles(self, current_pc: int, addr: int) -> int:
+        '''
+        Extra cycles taken by a branch from current_pc to addr
+        '''
+        # Same page (same high byte) only takes 1 clock cycle, a different
+        # page takes two
+        return 2 if (current_pc ^ addr) & 0xff00 else 1
+
+    def BCC(self, addr: int) -> None:
+        '''
+        Branch on carry clear
+        '''
+        self.BRA((C_FLAG, False), addr)
+
+    def BCS(self, addr: int) -> None:
+        '''
+        Branch on carry set
+        '''
+        self.BRA((C_FLAG, True), addr)
+
+    def BEQ(self, addr: int) -> None:
+        '''
+        Branch on result equal to zero (zero flag set)
+        '''
+        self.BRA((Z_FLAG, True), addr)
+
+    def BMI(self, addr: int) -> None:
+        '''
+        Branch on result minus (negative flag set)
+        '''
+        self.BRA((N_FLAG, True), addr)
+
+    def BNE(self, addr: int) -> None:
+        '''
+        Branch on result not equal to zero (zero flag clear)
+        '''
+        self.BRA((Z_FLAG, False), addr)
+
+    def BPL(self, addr: int) -> None:
+        '''
+        Branch on result plus (negative flag clear)
+        '''
+        self.BRA((N_FLAG, False), addr)
+
+    def BVC(self, addr: int) -> None:
+        '''
+        Branch on overflow clear
+        '''
+        self.BRA((V_FLAG, False), addr)
+
+    def BVS(self, addr: int) -> None:
+        '''
+        Branch on overflow set
+        '''
+        self.BRA((V_FLAG, True), addr)
 
     def BIT(self, value2: int) -> None:
         '''
         Performs bit test with value2. Doesn't modify any registers, but
         does changes the flags depending on the result
         '''
-        self.r.set_flag('Z', (self.r.a & value2) == 0)
-        self.r.set_flag('N', value2 & 0x80)
-        self.r.set_flag('V', value2 & 0x40)
+        r = self.r
+        # Bits 7 and 6 of value2 go straight into the negative and overflow
+        # flags, so clear them and zero flag with mask 00111101 first
+        zero = Z_FLAG if (r.a & value2) == 0 else 0
+        r.p = (r.p & 0x3d) | (value2 & 0xc0) | zero
 
     def BRK(self, _) -> None:
         '''
         Force break (software interrupt rather than hardware interrupt)
         '''
+        r = self.r
         # Need to set appropriate flag
-        self.r.set_flag('B')
+        r.p = r.p | B_FLAG
 
         # Push programme counter and status flag onto the stack
-        self.stack_push_word(self.r.pc+1)
-        self.stack_push(self.r.p)
+        self.stack_push_word(r.pc+1)
+        self.stack_push(r.p)
 
         # Set interrupt flat
-        self.r.set_flag('I')
+        r.p = r.p | I_FLAG
 
         # Set programme counter to value defined in interrupt routine
-        self.r.pc = self.interrupt_address('BRK')
+        r.pc = self.interrupt_address('BRK')
 
-    def CLR(self, flag: str) -> None:
+    def CLR(self, flag: int) -> None:
         '''
-        Clears the flag in the status register
+        Clears the flag (given by its mask) in the status register
         '''
-        self.r.set_flag(flag, False)
+        self.r.p = self.r.p & (0xff ^ flag)
 
     def __compare(self, register: int, value: int) -> None:
         '''
         Helper function to compare value with contents of given register. Used
         for CMP, CPX, CPY operations.
         '''
-        result = (register - value) & 0xff
-        self.r.set_flag('Z', result == 0)
-        self.r.set_flag('C', value <= register)
-        self.r.set_flag('N', result & 0x80)
+        r = self.r
+        # Carry is set if no borrow is needed. The zero and negative flags
+        # come from the result, which replaces any pending one, so their old
+        # bits don't need working out and carry can go straight into _p
+        r._p = (r._p & 0xfe) | (value <= register)
+        r._zn = (register - value) & 0xff
 
     def CMP(self, value2: int) -> None:
         '''
@@ -841,54 +1358,58 @@ class Processor:
         '''
         Decrement value in address by 1
         '''
-        value = self.mmu.read(addr) - 1
+        mem = self._mem
+        value = (mem[addr] - 1) & 0xff
         # Write value back to address
-        self.mmu.write(value & 0xff)
-        self.r.ZN(value & 0xff)
+        if self._read_only[addr]:
+            raise ReadOnlyError()
+        mem[addr] = self.r._zn = value
 
     def DEX(self, _) -> None:
         '''
         Decrement contents of x register by 1
         '''
-        self.r.x = (self.r.x - 1) & 0xff
-        self.r.ZN(self.r.x)
+        r = self.r
+        r.x = r._zn = (r.x - 1) & 0xff
 
     def DEY(self, _) -> None:
         '''
         Decrement contents of y register by 1
         '''
-        self.r.y = (self.r.y - 1) & 0xff
-        self.r.ZN(self.r.y)
+        r = self.r
+        r.y = r._zn = (r.y - 1) & 0xff
 
     def EOR(self, value2: int) -> None:
         '''
         Performs bitwise exclusive OR with contents of the accumulator
         '''
-        self.r.a = self.r.a ^ value2
-        self.r.ZN(self.r.a)
+        r = self.r
+        r.a = r._zn = r.a ^ value2
 
     def INC(self, addr: int) -> None:
         '''
         Increment value in address by 1
         '''
-        value = self.mmu.read(addr) + 1
+        mem = self._mem
+        value = (mem[addr] + 1) & 0xff
         # Write value back to address
-        self.mmu.write(value & 0xff)
-        self.r.ZN(value & 0xff)
+        if self._read_only[addr]:
+            raise ReadOnlyError()
+        mem[addr] = self.r._zn = value
 
     def INX(self, _) -> None:
         '''
         Increment contents of x register by 1
         '''
-        self.r.x = (self.r.x + 1) & 0xff
-        self.r.ZN(self.r.x)
+        r = self.r
+        r.x = r._zn = (r.x + 1) & 0xff
 
     def INY(self, _) -> None:
         '''
         Increment contents of y register by 1
         '''
-        self.r.y = (self.r.y + 1) & 0xff
-        self.r.ZN(self.r.y)
+        r = self.r
+        r.y = r._zn = (r.y + 1) & 0xff
 
     def JMP(self, addr: int) -> None:
         '''
@@ -908,44 +1429,48 @@ class Processor:
         '''
         Load value2 into the accumulator
         '''
-        self.r.a = value2
-        self.r.ZN(self.r.a)
+        r = self.r
+        r.a = r._zn = value2
 
     def LDX(self, value2: int) -> None:
         '''
         Load value into x register
         '''
-        self.r.x = value2
-        self.r.ZN(self.r.x)
+        r = self.r
+        r.x = r._zn = value2
 
     def LDY(self, value2: int) -> None:
         '''
         Load value into y register
         '''
-        self.r.y = value2
-        self.r.ZN(self.r.y)
+        r = self.r
+        r.y = r._zn = value2
 
     def LSR(self, addr: int) -> None:
         '''
         Shifts value in address to the right by 1 bit. If addr is 'a', this
         means that the operation acts on the accumulator
         '''
+        r = self.r
         if addr == 'a':
-            # If LSB is True, set the carry flag
-            self.r.set_flag('C', self.r.a & 0x01)
-            value = self.r.a >> 1
-            self.r.a = value
+            # Shift LSB into the carry flag
+            r.p = (r.p & 0xfe) | (r.a & 0x01)
+            value = r.a >> 1
+            r.a = value
         else:
             # Acts on a memory location, so read it in
-            value = self.mmu.read(addr)
-            # If LSB is True, set carry flag
-            self.r.set_flag('C', value & 0x01)
+            mem = self._mem
+            value = mem[addr]
+            # Shift LSB into the carry flag
+            r.p = (r.p & 0xfe) | (value & 0x01)
             # Shift value to the right and put back in memory
             value = value >> 1
-            self.mmu.write(value)
+            if self._read_only[addr]:
+                raise ReadOnlyError()
+            mem[addr] = value
 
         # Update zero and negative flags
-        self.r.ZN(value)
+        r._zn = value
 
     def NOP(self, _) -> None:
         '''
@@ -958,67 +1483,80 @@ class Processor:
         Performs the logical OR operation between value2 and contents of the
         accumulator
         '''
-        self.r.a = self.r.a | value2
-        self.r.ZN(self.r.a)
+        r = self.r
+        r.a = r._zn = r.a | value2
 
-    def PHS(self, value2: int) -> None:
+    def PHA(self, _) -> None:
         '''
-        Pushes value2 (from either accumulator or process register) onto the
-        stack
+        Pushes current contents of the accumulator onto the stack
         '''
-        self.stack_push(value2)
+        self.stack_push(self.r.a)
 
-    def PLS(self, reg: int) -> None:
+    def PHP(self, _) -> None:
         '''
-        Pulls value from stack and places it in appropriate place (reg)
+        Pushes current contents of the process status register onto the stack
         '''
-        # Get value from stack
-        value = self.stack_pull()
-        if reg == 'a':
-            # Place in the accumulator
-            self.r.a = value
-            # Update Z and N flag
-            self.r.ZN(value)
-        elif reg == 'p':
-            self.r.p = value | 0b00100000
+        self.stack_push(self.r.p)
+
+    def PLA(self, _) -> None:
+        '''
+        Pulls value from stack into the accumulator
+        '''
+        r = self.r
+        r.a = r._zn = self.stack_pull()
+
+    def PLP(self, _) -> None:
+        '''
+        Pulls value from stack into the process status register. The unused
+        bit always reads as set
+        '''
+        self.r.p = self.stack_pull() | U_FLAG
 
     def ROL(self, addr: int) -> None:
         '''
         Rotates a value in memory to the left by 1 bit
         '''
+        r = self.r
         if addr == 'a':
             # Operates on the accumulator
-            original = self.r.a
-            new = (original << 1) + self.r.get_flag('C')
-            self.r.a = new & 0xff
+            original = r.a
+            new = (original << 1) | (r.p & C_FLAG)
+            r.a = new & 0xff
         else:
             # Operates on values in memory location
-            original = self.mmu.read(addr)
-            new = (original << 1) + self.r.get_flag('C')
-            self.mmu.write(addr, new & 0xff)
+            mem = self._mem
+            original = mem[addr]
+            new = (original << 1) | (r.p & C_FLAG)
+            if self._read_only[addr]:
+                raise ReadOnlyError()
+            mem[addr] = new & 0xff
 
-        # Set flags
-        self.r.set_flag('C', original & 0x80)
-        self.r.ZN(new & 0xff)
+        # Set flags - bit 7 goes into the carry
+        r.p = (r.p & 0xfe) | (original >> 7)
+        r._zn = new & 0xff
 
     def ROR(self, addr: int) -> None:
         '''
         Rotates a value in memory to the right by 1 bit
         '''
+        r = self.r
         if addr == 'a':
             # Operates on the accumulator
-            original = self.r.a
-            new = (original >> 1) + self.r.get_flag('C')*0x80
-            self.r.a = new & 0xff
+            original = r.a
+            new = (original >> 1) | ((r.p & C_FLAG) << 7)
+            r.a = new & 0xff
         else:
             # Operates on memory location
-            original = self.mmu.read(addr)
-            new = (original >> 1) + self.r.get_flag('C')*0x80
-            self.mmu.write(addr, new & 0xff)
+            mem = self._mem
+            original = mem[addr]
+            new = (original >> 1) | ((r.p & C_FLAG) << 7)
+            if self._read_only[addr]:
+                raise ReadOnlyError()
+            mem[addr] = new & 0xff
 
-        # Set flags
-        self.r.set_flag('C', original & 0x01)
-        self.r.ZN(new & 0xff)
+        # Set flags - bit 0 goes into the carry
+        r.p = (r.p & 0xfe) | (original & 0x01)
+        r._zn = new & 0xff
 
     def RTI(self, _) -> None:
         '''
@@ -1039,62 +1577,107 @@ class Processor:
         '''
         Performs subtract with carry operation between value2 and accumulator.
         '''
-        value1 = self.r.a
+        r = self.r
+        value1 = r.a
+        p = r.p
+
+        # Borrow is the inverse of the carry flag
+        borrow = (p & C_FLAG) ^ 1
 
         # Check if in decimal or binary mode
-        if self.r.get_flag('D'):
+        if p & D_FLAG:
             # Convert numbers from BCD
-            value1 = self.from_BCD(value1)
-            value2 = self.from_BCD(value2)
+            value1 = _FROM_BCD[value1]
+            value2 = _FROM_BCD[value2]
 
             # Perform subtraction
-            result = value1 - value2 - (not self.r.get_flag('C'))
-            self.r.a = self.to_BCD(result % 100)
+            result = value1 - value2 - borrow
+            r.a = _TO_BCD[result % 100]
         else:
-            result = value1 - value2 - (not self.r.get_flag('C'))
-            self.r.a = result & 0xff
+            result = value1 - value2 - borrow
+            r.a = result & 0xff
+
+        # Carry is set if no borrow was needed. Overflow if sign of result
+        # differs from that of accumulator, when inputs had different signs
+        carry = result >= 0
+        overflow = (value1 ^ value2) & (value1 ^ result) & 0x80
 
-        # Set flags
-        self.r.set_flag('C', result >= 0)
-        self.r.set_flag('V', ((value1 ^ value2) & (value1 ^ result) & 0x80))
-        self.r.ZN(self.r.a)
+        # Set carry (bit 0) and overflow (bit 6) flags in a single update,
+        # clearing both with mask 10111110 first
+        r.p = (p & 0xbe) | (overflow >> 1) | carry
+        r._zn = r.a
 
     def SET(self, flag: int) -> None:
         '''
-        Sets the appropriate flag
+        Sets the flag (given by its mask) in the status register
         '''
-        self.r.set_flag(flag, True)
+        self.r.p = self.r.p | flag
 
     def STA(self, addr: int) -> None:
         '''
         Stores accumulator into given address
         '''
-        self.mmu.write(addr, self.r.a)
+        if self._read_only[addr]:
+            raise ReadOnlyError()
+        self._mem[addr] = self.r.a
 
     def STX(self, addr: int) -> None:
         '''
         Stores x-register into given address
         '''
-        self.mmu.write(addr, self.r.x)
+        if self._read_only[addr]:
+            raise ReadOnlyError()
+        self._mem[addr] = self.r.x
 
     def STY(self, addr: int) -> None:
         '''
-        Stores accumulator into given address
+        Stores y-register into given address
+        '''
+        if self._read_only[addr]:
+            raise ReadOnlyError()
+        self._mem[addr] = self.r.y
+
+    def TAX(self, _) -> None:
+        '''
+        Transfers accumulator to x register
+        '''
+        r = self.r
+        r.x = r._zn = r.a
+
+    def TAY(self, _) -> None:
+        '''
+        Transfers accumulator to y register
+        '''
+        r = self.r
+        r.y = r._zn = r.a
+
+    def TSX(self, _) -> None:
+        '''
+        Transfers stack pointer to x register
+        '''
+        r = self.r
+        r.x = r._zn = r.sp
+
+    def TXA(self, _) -> None:
+        '''
+        Transfers x register to accumulator
+        '''
+        r = self.r
+        r.a = r._zn = r.x
+
+    def TXS(self, _) -> None:
+        '''
+        Transfers x register to stack pointer. Unlike the other transfers,
+        this doesn't change any flags
         '''
-        self.mmu.write(addr, self.r.y)
+        self.r.sp = self.r.x
 
-    def TRA(self, regs: int) -> None:
+    def TYA(self, _) -> None:
         '''
-        Transfers values between two registers, given in 2-tuple regs. So,
-        transferring from X to A would be regs=('x', 'a')
+        Transfers y register to accumulator
         '''
-        source, dest = regs
-        source_value = getattr(self.r, source)
-        # Set value to destination register
-        setattr(self.r, dest, source_value)
-        # Need to update Z and N flags (if destination is not stack)
-        if dest != 's':
-            self.r.ZN(source_value)
+        r = self.r
+        r.a = r._zn = r.y
 
 
 class InvalidInstructionError(ValueError):
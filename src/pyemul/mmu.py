@@ -4,11 +4,11 @@ Created on Tue Sep  6 16:56:29 2022
 
 @author: SamHill
 """
-import array
 from typing import Union
+import warnings
 
 
-block_type = tuple[int, int, str, bool, Union[None, bytearray]]
+block_type = tuple[int, Union[None, int], str, bool, Union[None, bytearray]]
 
 
 class MMU:
@@ -21,12 +21,16 @@ class MMU:
         Initialise the various blocks of virtual memory that the 6502 can
         address.
         '''
-        # Create array - know that it'll be $FFFF bytes long. Initialise all
-        # values to zero for now
-        self.memory = array.array('B', 0xffff*[0])
+        # Create byte array - 16 bit addresses mean it'll be $10000 bytes long,
+        # so each address is a direct index. Initialise all values to zero
+        self.memory = bytearray(0x10000)
 
         # Also will want another mask to know whether it is read only
-        self._read_only = array.array('B', 0xffff*[0])
+        self._read_only = bytearray(0x10000)
+
+        # Mark which addresses already belong to a block, so a new block can
+        # be checked for overlaps with a single search
+        self._allocated = bytearray(0x10000)
 
         # Keep track of memory blocks
         self.blocks = []
@@ -35,7 +39,7 @@ class MMU:
         for b in blocks:
             self.add_block(*b)
 
-    def add_block(self, start_addr: int, length: int, name: str,
+    def add_block(self, start_addr: int, length: Union[None, int], name: str,
                   read_only: bool = False,
                   data: Union[None, bytearray] = None) -> None:
         '''
@@ -43,35 +47,53 @@ class MMU:
         block.
         Inputs:
             start_addr      -   Start address of memory block
-            length          -   Number of bytes of memory block
+            length          -   Number of bytes of memory block. If None,
+                                the block is sized to fit data exactly
             name            -   Human readable name to know wha
             read_only       -   Boolean flag to say whether writes are allowed
-            data            -   data to initialise datablock to.
+            data            -   data to initialise datablock to. Data longer
+                                than the block is deprecated - anything past
+                                the end of the block is dropped
         '''
-        # First, check that there is no memory clash - loop through memory
-        # blocks that have already be allocated
+        if length is None:
+            length = len(data)
+        elif data is not None and len(data) > length:
+            # Older code gave len(data) - 1 as the length, which cuts the
+            # data short. Still allowed for now, but warn about it
+            warnings.warn(f'{len(data) - length} bytes of data past the end '
+                          f'of block {name!r} are dropped - pass None as the '
+                          'length to size the block to fit its data',
+                          DeprecationWarning, stacklevel=2)
+
+        # First, check that there is no memory clash with blocks that have
+        # already been allocated
         end = start_addr + length
-        for block in self.blocks:
-            # Check that start of memory block is not between existing
-            start_chk = (start_addr > block['start']) and (start_addr < (block['start'] + block['length']))
-            end_chk = (end > block['start']) and (end < (block['start'] + block['length']))
-            if start_chk or end_chk:
-                # Overlap of memory - not free to allocate
-                raise MemoryRangeError()
+        if start_addr < 0 or end > len(self.memory):
+            # Block doesn't fit in 16 bit address space
+            raise MemoryRangeError()
+
+        if self._allocated.find(1, start_addr, end) != -1:
+            # Overlap of memory - not free to allocate
+            raise MemoryRangeError()
+        self._allocated[start_addr:end] = length*b'\x01'
 
         # Free to allocate memory - store as an array
         new_mem = {'start': start_addr, 'length': length,
                    'name': name, 'read-only': read_only}
 
-        # Define whether it is read only or not
+        # Define whether it is read only or not - set whole block in one go
         if read_only:
-            for addr in range(start_addr, end):
-                self._read_only[addr] = 1
+            self._read_only[start_addr:end] = length*b'\x01'
 
-        # If there is data to be initialised, do so:
+        # If there is data to be initialised, copy it in as a single slice.
+        # Byte data (e.g. a ROM image read from file) is copied straight from
+        # its buffer, anything else (e.g. list of ints) needs converting first
         if data:
-            for addr in range(start_addr, end):
-                self.memory[addr] = data[addr - start_addr]
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                values = memoryview(data)[:length]
+            else:
+                values = bytes(data[:length])
+            self.memory[start_addr:start_addr + len(values)] = values
 
         # Add memory block to list of blocks
         self.blocks.append(new_mem)
@@ -92,6 +114,12 @@ class MMU:
 
         self.memory[addr] = value
 
+    def is_read_only(self, addr: int) -> bool:
+        '''
+        Returns whether the address is in a read only block of memory
+        '''
+        return bool(self._read_only[addr])
+
 
 class MemoryRangeError(ValueError):
     pass
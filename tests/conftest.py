@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  conftest.py
+#
+'''
+Fixtures shared between the test modules
+'''
+import os
+import pytest
+
+from pyemul.mmu import MMU
+
+
+@pytest.fixture
+def divide_mmu():
+    '''
+    Read in compiled programme from file
+    '''
+    cwd = os.getcwd()
+    filename = os.path.join(cwd, 'docs', 'files', 'dividenumber.out')
+
+    with open(filename, 'rb') as fi:
+        instructions = fi.read()
+
+    # Use this to setup memory device
+    mems = MMU(((0, 0x3fff, 'RAM', False),
+                (0x8000, len(instructions), 'ROM',
+                True, instructions)))
+    return mems
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_codegen.py
+#
+'''
+Tests the code generated for blocks of instructions held in ROM
+'''
+import pytest
+
+from pyemul.codegen import (MODE_SOURCE, OP_SOURCE, compile_block,
+                            compile_handler, compile_ram_block)
+from pyemul.cpu import C_FLAG, D_FLAG, U_FLAG, InvalidInstructionError, \
+    Processor
+from pyemul.mmu import ReadOnlyError
+
+
+def state(cpu):
+    '''
+    Registers, cycle count and the bottom of memory (zero page, stack and the
+    code the tests write there), for comparing two ways of running the same
+    instructions
+    '''
+    return (cpu.r.pc, cpu.r.a, cpu.r.x, cpu.r.y, cpu.r.sp, cpu.r.p,
+            cpu.cycles, bytes(cpu._mem[:0x300]))
+
+
+def test_compile_block(divide_mmu):
+    '''
+    Tests that running a compiled block gives the same result as stepping
+    through the same instructions
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.predecode(0x8000, 0x8000)
+
+    # First block runs from reset up to and including the first branch
+    block, count, end_addr = compile_block(cpu, 0x8000)
+    assert count == 20
+    assert end_addr == 0x8031
+
+    block(cpu)
+
+    stepped = Processor(divide_mmu)
+    for _ in range(count):
+        stepped.step()
+
+    assert cpu.r.pc == stepped.r.pc
+    assert cpu.r.a == stepped.r.a
+    assert cpu.r.p == stepped.r.p
+    assert cpu.cycles == stepped.cycles
+
+
+def test_compile_block_not_decoded(divide_mmu):
+    '''
+    Tests that nothing is compiled for addresses that have not been
+    predecoded
+    '''
+    cpu = Processor(divide_mmu)
+    assert compile_block(cpu, 0x8000) is None
+
+
+def test_compile_block_cached(divide_mmu):
+    '''
+    Tests that a second processor running the same ROM reuses the code
+    compiled for the first
+    '''
+    first = Processor(divide_mmu)
+    first.predecode(0x8000, 0x8000)
+    second = Processor(divide_mmu)
+    second.predecode(0x8000, 0x8000)
+
+    block1, _, _ = compile_block(first, 0x8000)
+    block2, _, _ = compile_block(second, 0x8000)
+    assert block1.__code__ is block2.__code__
+
+
+def test_compile_handler(divide_mmu):
+    '''
+    Tests that running instructions through their opcode handlers gives the
+    same result as decoding them
+    '''
+    # Both processors share memory, so keep a copy to start the second from
+    ram = bytes(divide_mmu.memory)
+
+    cpu = Processor(divide_mmu)
+    handled = []
+    for _ in range(50):
+        handler = compile_handler(cpu, cpu._mem[cpu.r.pc])
+        handler(cpu)
+        handled.append(state(cpu))
+
+    divide_mmu.memory[:] = ram
+    cpu = Processor(divide_mmu)
+    cpu.trace = lambda name, value: None
+    decoded = []
+    for _ in range(50):
+        cpu.step()
+        decoded.append(state(cpu))
+
+    assert handled == decoded
+
+
+def test_handlers_distinct(divide_mmu):
+    '''
+    Tests that every opcode has its own handler code
+    '''
+    cpu = Processor(divide_mmu)
+    codes = {handler.__code__ for handler in cpu._handlers}
+    assert len(codes) == 0x100
+
+
+def test_handlers_shared(divide_mmu):
+    '''
+    Tests that processors with the same methods share their handlers, and
+    that a subclass overriding a method gets its own
+    '''
+    class Loading(Processor):
+        def LDA(self, value2):
+            super().LDA(value2)
+
+    first = Processor(divide_mmu)
+    second = Processor(divide_mmu)
+    assert first._handlers == second._handlers
+
+    # Only the handlers for LDA need different code
+    loading = Loading(divide_mmu)
+    assert loading._handlers[0xa9].__code__ is not \
+        first._handlers[0xa9].__code__
+    assert loading._handlers[0xea].__code__ is first._handlers[0xea].__code__
+    assert Loading(divide_mmu)._handlers == loading._handlers
+
+
+def test_handler_invalid(divide_mmu):
+    '''
+    Tests that the handler for an invalid opcode raises an error
+    '''
+    cpu = Processor(divide_mmu, program_counter=0x1000)
+    cpu._mem[0x1000] = 0x02
+    with pytest.raises(InvalidInstructionError):
+        cpu.step()
+
+
+@pytest.mark.parametrize("mode", sorted(MODE_SOURCE))
+def test_mode_source(divide_mmu, mode):
+    '''
+    Tests that the source written into handlers for each addressing mode does
+    the same as the Processor method it replaces, including page crossings
+    '''
+    setup, value = MODE_SOURCE[mode]
+    source = ('def inline(cpu, operand):\n    r = cpu.r\n    mem = cpu._mem\n'
+              '    page_cross = 0\n')
+    source += ''.join(f'    {line}\n' for line in setup)
+    source += f'    cpu.cycles += page_cross\n    return {value}\n'
+    namespace = {}
+    exec(source, namespace)
+    inline = namespace['inline']
+
+    # Pointers in zero page, for the indirect modes
+    for addr in range(0x100):
+        divide_mmu.write(addr, (addr * 37) & 0xff)
+
+    cpu = Processor(divide_mmu)
+    method = getattr(cpu, mode)
+    operands = [0x00, 0x7f, 0x80, 0xfe, 0xff]
+    if cpu._operand_bytes[method] == 2:
+        operands += [0x20f0, 0x3fff]
+    for operand in operands:
+        for index in (0x00, 0x01, 0x10, 0xff):
+            cpu.r.x = index
+            cpu.r.y = index
+            cycles = cpu.cycles
+            expected = method(operand)
+            extra = cpu.cycles - cycles
+
+            cpu.cycles = cycles
+            assert inline(cpu, operand) == expected
+            assert cpu.cycles - cycles == extra
+
+
+@pytest.mark.parametrize("code", [
+    # LDA #$05, STA $0200, LDX #$03, DEX, BNE back to DEX
+    'a9 05 8d 00 02 a2 03 ca d0 fd',
+    # As above, but the branch isn't taken
+    'a9 05 8d 00 02 a2 01 ca d0 fd',
+    # LDY $10, STY $20,X, INY, BEQ forwards
+    'a4 10 94 20 c8 f0 10',
+    # LDA #$05, CMP #$05, BEQ forwards, then CMP #$06, BNE backwards
+    'a9 05 c9 05 f0 10',
+    'a9 05 c9 06 d0 f0',
+    # CPX $10, BNE across a page
+    'e4 10 d0 7f',
+])
+def test_fused_pairs(divide_mmu, code):
+    '''
+    Tests that blocks running pairs of instructions as one give the same
+    result as stepping through them, and make no calls for the pairs
+    '''
+    code = bytes.fromhex(code)
+    divide_mmu.memory[0x10ff - len(code):0x10ff] = code
+    divide_mmu.memory[0x10] = 0xff
+    start = 0x10ff - len(code)
+
+    cpu = Processor(divide_mmu, program_counter=start)
+    cpu.r.x = 0x31
+    cpu.trace = lambda name, value: None
+    ram = bytes(divide_mmu.memory)
+    block, count, _ = compile_ram_block(cpu, start)
+    for _ in range(count):
+        cpu.step()
+    stepped = state(cpu)
+
+    divide_mmu.memory[:] = ram
+    cpu = Processor(divide_mmu, program_counter=start)
+    cpu.r.x = 0x31
+    block(cpu)
+    assert state(cpu) == stepped
+    names = {'LDA', 'LDX', 'LDY', 'STA', 'STY', 'CMP', 'CPX',
+             'DEX', 'INY', 'BEQ', 'BNE'}
+    assert not names & set(block.__code__.co_names)
+
+
+def test_fused_store_read_only(divide_mmu):
+    '''
+    Tests that a fused load and store still refuses to write to ROM
+    '''
+    cpu = Processor(divide_mmu, program_counter=0x1000)
+    # LDA #$01, STA $8000
+    cpu._mem[0x1000:0x1005] = bytes.fromhex('a9 01 8d 00 80')
+    block, _, _ = compile_ram_block(cpu, 0x1000)
+    with pytest.raises(ReadOnlyError):
+        block(cpu)
+
+
+@pytest.mark.parametrize("operation", sorted(OP_SOURCE))
+def test_op_source(divide_mmu, operation):
+    '''
+    Tests that the source written into handlers and blocks for each
+    operation does the same as the Processor method it replaces, including
+    ADC and SBC in decimal mode
+    '''
+    namespace = {'ReadOnlyError': ReadOnlyError}
+    source = 'def inline(cpu, value):\n    r = cpu.r\n    mem = cpu._mem\n'
+    source += ''.join(f'    {line}\n' for line in OP_SOURCE[operation])
+    source += '    pass\n'
+    cpu = Processor(divide_mmu)
+    namespace[operation] = getattr(Processor, operation)
+    exec(source, namespace)
+    inline = namespace['inline']
+    method = getattr(cpu, operation)
+    ram = bytes(divide_mmu.memory)
+
+    for p in (U_FLAG, U_FLAG | C_FLAG, U_FLAG | D_FLAG,
+              U_FLAG | D_FLAG | C_FLAG, 0xff):
+        for register in (0x00, 0x01, 0x45, 0x7f, 0x80, 0x99, 0xff):
+            for value in (0x00, 0x01, 0x38, 0x7f, 0x80, 0x99, 0xff):
+                results = []
+                for run in (method, lambda value: inline(cpu, value)):
+                    divide_mmu.memory[:] = ram
+                    cpu.r.p = p
+                    # Leave zero and negative flags pending from a load
+                    cpu.LDA(register ^ 0x80)
+                    cpu.r.a = cpu.r.x = cpu.r.y = cpu.r.sp = register
+                    cpu.r.pc = 0x1234
+                    run(value)
+                    results.append(state(cpu))
+                assert results[0] == results[1]
+
+
+@pytest.mark.parametrize("operation", ['ADC', 'SBC', 'TAY',
+                                       'LDA', 'STA', 'DEX', 'BNE',
+                                       '_load_addr_value', '_relative'])
+def test_overridden(divide_mmu, operation):
+    '''
+    Tests that an operation or addressing mode overridden by a subclass is
+    always called, rather than written out, so running the programme calls it
+    the same number of times whether or not it is traced. ADC and SBC are
+    called in binary mode too, not just decimal
+    '''
+    def counted(self, value):
+        self.calls += 1
+        return getattr(Processor, operation)(self, value)
+    counted.__name__ = operation
+    Counting = type('Counting', (Processor,), {operation: counted})
+
+    ram = bytes(divide_mmu.memory)
+    results = []
+    for traced in (False, True):
+        divide_mmu.memory[:] = ram
+        cpu = Counting(divide_mmu)
+        cpu.calls = 0
+        if traced:
+            cpu.trace = lambda name, value: None
+        cpu.run_until(0x8040)
+        results.append((state(cpu), cpu.calls))
+
+    assert results[0] == results[1]
+
+    # Handlers for code in writable memory call it too
+    for opcode, op in enumerate(cpu._op_table):
+        if op is not None and operation in (
+                op[1].__name__, getattr(op[2], '__name__', None)):
+            assert operation in cpu._handlers[opcode].__code__.co_names
@@ -28,25 +28,9 @@ import os
 import pytest
 
 from pyemul.cpu import Processor, InvalidInstructionError
-from pyemul.mmu import MMU
-
-
-@pytest.fixture
-def divide_mmu():
-    '''
-    Read in compiled programme from file
-    '''
-    cwd = os.getcwd()
-    filename = os.path.join(cwd, 'docs', 'files', 'dividenumber.out')
-
-    with open(filename, 'rb') as fi:
-        instructions = fi.read()
-
-    # Use this to setup memory device
-    mems = MMU(((0, 0x3fff, 'RAM', False),
-                (0x8000, len(instructions)-1, 'ROM',
-                True, instructions)))
-    return mems
+from pyemul.cpu import B_FLAG, C_FLAG, D_FLAG, I_FLAG, N_FLAG, U_FLAG, \
+    Z_FLAG
+from pyemul.mmu import MMU, ReadOnlyError
 
 
 def test_setup_cpu(divide_mmu):
@@ -141,3 +125,699 @@ def test_ZN(divide_mmu, value, expected):
     # Check values are correct
     assert cpu.r.get_flag('Z') == expected[0]
     assert cpu.r.get_flag('N') == expected[1]
+
+
+def test_run(divide_mmu):
+    '''
+    Tests that running a batch of instructions leaves the CPU in the same
+    state as stepping through them one at a time
+    '''
+    stepped = Processor(divide_mmu)
+    for _ in range(20):
+        stepped.step()
+
+    batched = Processor(divide_mmu)
+    batched.run(20)
+
+    assert batched.r.pc == stepped.r.pc
+    assert batched.r.p == stepped.r.p
+    assert batched.cycles == stepped.cycles
+
+
+def test_predecode(divide_mmu):
+    '''
+    Tests that predecoding the programme in ROM gives the same results as
+    decoding each instruction as it is executed, and that RAM is not cached
+    '''
+    decoded = Processor(divide_mmu)
+    decoded.predecode(0x8000, 0x8000)
+    assert decoded._decoded[0x8000] is not None
+
+    # Writable memory should never be cached
+    decoded.predecode(0x0000, 0x100)
+    assert all(entry is None for entry in decoded._decoded[:0x100])
+
+    decoded.run(20)
+
+    plain = Processor(divide_mmu)
+    plain.run(20)
+
+    assert decoded.r.pc == plain.r.pc
+    assert decoded.r.a == plain.r.a
+    assert decoded.cycles == plain.cycles
+
+
+def test_decode_ahead(divide_mmu):
+    '''
+    Tests that instructions in ROM are decoded and kept the first time they
+    are run, up to the end of the block, but RAM is not
+    '''
+    cpu = Processor(divide_mmu)
+    assert cpu.decode_ahead(0x8000) is not None
+
+    # Decoding stops after first branch instruction, at $802f
+    assert cpu._decoded[0x802f] is not None
+    assert cpu._decoded[0x8031] is None
+
+    assert cpu.decode_ahead(0x0000) is None
+    assert cpu._decoded[0x0000] is None
+
+    # Running ROM without predecoding still compiles it into blocks
+    cpu = Processor(divide_mmu)
+    cpu.run(20)
+    assert cpu._blocks[0x8000] is not None
+
+
+def test_run_blocks():
+    '''
+    Tests that running the whole programme from compiled blocks gives the
+    same result as stepping through it one instruction at a time
+    '''
+    filename = os.path.join(os.getcwd(), 'docs', 'files', 'dividenumber.out')
+    with open(filename, 'rb') as fi:
+        instructions = fi.read()
+
+    results = []
+    for use_blocks in (False, True):
+        mems = MMU(((0, 0x3fff, 'RAM', False),
+                    (0x8000, len(instructions), 'ROM', True, instructions)))
+        cpu = Processor(mems)
+        if use_blocks:
+            cpu.predecode(0x8000, len(instructions))
+            cpu.run(227)
+            assert cpu._blocks[0x8000] is not None
+        else:
+            for _ in range(227):
+                cpu.step()
+        results.append((cpu.r.pc, cpu.r.a, cpu.r.x, cpu.r.y, cpu.r.p,
+                        cpu.cycles, mems.memory[0x2000:0x2004]))
+
+    assert results[0] == results[1]
+    # 16320 / 10 = 1632 remainder 0
+    assert list(results[1][-1]) == [0x60, 0x06, 0, 0]
+
+
+def test_ZN_deferred(divide_mmu):
+    '''
+    Tests that zero and negative flags set by ZN are kept when other flags
+    are changed, and replaced when the whole status register is set
+    '''
+    cpu = Processor(divide_mmu)
+
+    cpu.r.ZN(0)
+    cpu.r.set_flag('C')
+    assert cpu.r.get_flag('Z') and cpu.r.get_flag('C')
+    assert not cpu.r.get_flag('N')
+
+    cpu.r.ZN(0x80)
+    cpu.r.p = cpu.r.flagbyte['?']
+    assert not cpu.r.get_flag('N')
+    assert cpu.r.p == cpu.r.flagbyte['?']
+
+
+def test_stack_pointer_transfer():
+    '''
+    Tests that TXS and TSX move values between the x register and the stack
+    pointer
+    '''
+    # LDX #$80, TXS, LDX #$00, TSX
+    programme = [0xa2, 0x80, 0x9a, 0xa2, 0x00, 0xba]
+    mems = MMU(((0, 0x3fff, 'RAM', False),
+                (0x8000, len(programme), 'ROM', True, programme)))
+    cpu = Processor(mems, program_counter=0x8000)
+
+    cpu.run(2)
+    assert cpu.r.sp == 0x80
+
+    cpu.run(2)
+    assert cpu.r.x == 0x80
+    assert cpu.r.get_flag('N')
+
+
+@pytest.mark.parametrize("instruction, source, dest", [
+    ('TAX', 'a', 'x'), ('TAY', 'a', 'y'), ('TXA', 'x', 'a'),
+    ('TYA', 'y', 'a'), ('TSX', 'sp', 'x'),
+])
+def test_transfer(divide_mmu, instruction, source, dest):
+    '''
+    Tests that register transfers copy the value and set the zero and
+    negative flags from it
+    '''
+    cpu = Processor(divide_mmu)
+    for value in (0x00, 0x42, 0x80):
+        setattr(cpu.r, source, value)
+        getattr(cpu, instruction)(None)
+        assert getattr(cpu.r, dest) == value
+        assert cpu.r.get_flag(Z_FLAG) == (value == 0)
+        assert cpu.r.get_flag(N_FLAG) == bool(value & 0x80)
+
+    # TXS is the only transfer that leaves the flags alone
+    cpu.r.x = 0x00
+    cpu.TXS(None)
+    assert cpu.r.sp == 0x00
+    assert cpu.r.get_flag(N_FLAG)
+
+
+@pytest.mark.parametrize("predecode", [False, True])
+def test_run_until(divide_mmu, predecode):
+    '''
+    Tests that running until the programme reaches its final loop stops at
+    the right place, including when the stop address is in the middle of a
+    compiled block
+    '''
+    cpu = Processor(divide_mmu)
+    if predecode:
+        cpu.predecode(0x8000, 0x8000)
+
+    # Stop part way through the first block (sta mod10 + 1)
+    assert cpu.run_until(0x8011) == 6
+    assert cpu.r.pc == 0x8011
+
+    # Programme finishes in 'loop: jmp loop'
+    assert cpu.run_until(0x8040) == 221
+    assert cpu.r.pc == 0x8040
+
+    # Gives up after max_steps if never reached
+    assert cpu.run_until(0x9000, max_steps=5) == 5
+
+
+def test_run_compiles_only_blocks_run(divide_mmu):
+    '''
+    Tests that blocks are not compiled while tracing, nor for instructions in
+    the middle of a block that is being stepped through
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.trace = lambda name, value: None
+    cpu.run_until(0x8040)
+    assert all(block is None for block in cpu._blocks)
+
+    # First block is 20 instructions long, so doesn't fit
+    cpu = Processor(divide_mmu)
+    assert cpu.run(5) == 5
+    assert cpu._blocks[0x8000] is not None
+    assert sum(block is not None for block in cpu._blocks) == 1
+
+
+@pytest.mark.parametrize("a, value, carry, expected", [
+    (0x50, 0x10, False, (0x60, False, False)),
+    (0x50, 0x50, False, (0xa0, False, True)),
+    (0xd0, 0x90, False, (0x60, True, True)),
+    (0xff, 0x00, True, (0x00, True, False)),
+])
+def test_ADC_flags(divide_mmu, a, value, carry, expected):
+    '''
+    Tests that add with carry sets the accumulator, carry and overflow flags
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.a = a
+    cpu.r.set_flag('C', carry)
+    cpu.r.set_flag('V', True)
+
+    cpu.ADC(value)
+
+    assert (cpu.r.a, cpu.r.get_flag('C'), cpu.r.get_flag('V')) == expected
+    assert cpu.r.get_flag('Z') == (expected[0] == 0)
+
+
+@pytest.mark.parametrize("a, value, carry, expected", [
+    (0x50, 0xf0, True, (0x60, False, False)),
+    (0x50, 0xb0, True, (0xa0, False, True)),
+    (0xd0, 0x70, True, (0x60, True, True)),
+    (0x01, 0x00, False, (0x00, True, False)),
+])
+def test_SBC_flags(divide_mmu, a, value, carry, expected):
+    '''
+    Tests that subtract with carry sets the accumulator, carry and overflow
+    flags
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.a = a
+    cpu.r.set_flag('C', carry)
+    cpu.r.set_flag('V', True)
+
+    cpu.SBC(value)
+
+    assert (cpu.r.a, cpu.r.get_flag('C'), cpu.r.get_flag('V')) == expected
+    assert cpu.r.get_flag('Z') == (expected[0] == 0)
+
+
+def test_trace(divide_mmu):
+    '''
+    Tests that nothing is traced by default, and that a trace function is
+    called for each instruction when set, even from predecoded ROM
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.predecode(0x8000, 0x8000)
+    cpu.run(2)
+
+    traced = []
+    cpu.trace = lambda name, value: traced.append((name, value))
+    cpu.step()
+    cpu.run(2)
+
+    assert traced == [('LDA A', 0x3f), ('STA A', 0x2001), ('LDA Im', 0)]
+
+
+@pytest.mark.parametrize("register, value, expected", [
+    (0x40, 0x40, (True, True, False)),
+    (0x40, 0x41, (False, False, True)),
+    (0x41, 0x40, (True, False, False)),
+    (0xff, 0x00, (True, False, True)),
+])
+def test_compare_flags(divide_mmu, register, value, expected):
+    '''
+    Tests that compare sets the carry, zero and negative flags
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.a = register
+    cpu.CMP(value)
+
+    assert (cpu.r.get_flag(C_FLAG), cpu.r.get_flag(Z_FLAG),
+            cpu.r.get_flag(N_FLAG)) == expected
+
+
+def test_compare_keeps_flags(divide_mmu):
+    '''
+    Tests that compare only changes the carry, zero and negative flags, and
+    replaces any zero and negative flags still pending from an earlier result
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.p = U_FLAG | D_FLAG | C_FLAG
+    # LDA #$00 leaves the zero flag pending
+    cpu.LDA(0x00)
+    cpu.r.x = 0x40
+    cpu.CPX(0x41)
+    assert cpu.r.p == U_FLAG | D_FLAG | N_FLAG
+
+    cpu.CPX(0x40)
+    assert cpu.r.p == U_FLAG | D_FLAG | Z_FLAG | C_FLAG
+
+
+def test_flag_masks(divide_mmu):
+    '''
+    Tests that flags can be given by name or mask, and that the set and clear
+    instructions only change their own flag
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.p = U_FLAG
+    cpu.SET(D_FLAG)
+    assert cpu.r.get_flag('D')
+    cpu.r.set_flag('C')
+    assert cpu.r.p == U_FLAG | D_FLAG | C_FLAG
+    cpu.CLR(D_FLAG)
+    assert cpu.r.p == U_FLAG | C_FLAG
+    cpu.r.set_flag(C_FLAG, False)
+    assert cpu.r.p == U_FLAG
+
+
+@pytest.mark.parametrize("addr, offset, expected, extra", [
+    (0x20f0, 0x0f, 0x20ff, 0),
+    (0x20f0, 0x10, 0x2100, 1),
+    (0x20ff, 0x00, 0x20ff, 0),
+    (0xfff0, 0x20, 0x0010, 1),
+])
+def test_indexed_page_cross(divide_mmu, addr, offset, expected, extra):
+    '''
+    Tests that indexed addressing adds the correct register, and takes an
+    extra cycle only when it moves onto a different page
+    '''
+    cpu = Processor(divide_mmu)
+
+    cpu.r.x = offset
+    cycles = cpu.cycles
+    assert cpu._load_addr_x(addr) == expected
+    assert cpu.cycles == cycles + extra
+
+    # Y-indexed mode must use the y register, not x
+    cpu.r.x = 0
+    cpu.r.y = offset
+    cycles = cpu.cycles
+    assert cpu._load_addr_y(addr) == expected
+    assert cpu.cycles == cycles + extra
+
+
+@pytest.mark.parametrize("pc, addr, extra", [
+    (0x20fe, 0x20ff, 1),
+    (0x20ff, 0x2100, 2),
+    (0x2000, 0x1fff, 2),
+    # Pages are $100 bytes, not $ff
+    (0x20de, 0x20df, 1),
+])
+def test_branch_page_cross(divide_mmu, pc, addr, extra):
+    '''
+    Tests that a taken branch takes an extra cycle only when it goes to a
+    different 256 byte page
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.pc = pc
+    cpu.r.set_flag(Z_FLAG, False)
+    cycles = cpu.cycles
+    cpu.BNE(addr)
+    assert cpu.r.pc == addr
+    assert cpu.cycles == cycles + extra
+
+
+def test_indirect_y(divide_mmu):
+    '''
+    Tests that indirect y-indexed addressing gives the pointer plus the y
+    register, with an extra cycle when that crosses a page
+    '''
+    cpu = Processor(divide_mmu)
+    divide_mmu.write(0x10, 0xf0)
+    divide_mmu.write(0x11, 0x20)
+
+    cpu.r.y = 0x05
+    cycles = cpu.cycles
+    assert cpu._load_iy(0x10) == 0x20f5
+    assert cpu.cycles == cycles
+
+    cpu.r.y = 0x20
+    assert cpu._load_iy(0x10) == 0x2110
+    assert cpu.cycles == cycles + 1
+
+
+@pytest.mark.parametrize("a, value, carry, expected", [
+    (0x15, 0x26, False, (0x41, False)),
+    (0x58, 0x46, True, (0x05, True)),
+    (0x99, 0x99, True, (0x99, True)),
+    (0x00, 0x00, False, (0x00, False)),
+])
+def test_ADC_decimal(divide_mmu, a, value, carry, expected):
+    '''
+    Tests that add with carry works in decimal mode, keeping the last two
+    digits and carrying anything over 99
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.a = a
+    cpu.r.set_flag(D_FLAG)
+    cpu.r.set_flag(C_FLAG, carry)
+
+    cpu.ADC(value)
+
+    assert (cpu.r.a, cpu.r.get_flag(C_FLAG)) == expected
+
+
+@pytest.mark.parametrize("a, value, carry, expected", [
+    (0x46, 0x12, True, (0x34, True)),
+    (0x40, 0x13, False, (0x26, True)),
+    (0x12, 0x21, True, (0x91, False)),
+])
+def test_SBC_decimal(divide_mmu, a, value, carry, expected):
+    '''
+    Tests that subtract with carry works in decimal mode
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.a = a
+    cpu.r.set_flag(D_FLAG)
+    cpu.r.set_flag(C_FLAG, carry)
+
+    cpu.SBC(value)
+
+    assert (cpu.r.a, cpu.r.get_flag(C_FLAG)) == expected
+
+
+def test_BCD_tables(divide_mmu):
+    '''
+    Tests conversion to and from binary-coded decimal
+    '''
+    cpu = Processor(divide_mmu)
+    assert all(cpu.from_BCD(cpu.to_BCD(n)) == n for n in range(100))
+    assert cpu.from_BCD(0x42) == 42
+    assert cpu.to_BCD(99) == 0x99
+
+
+def test_store_read_only(divide_mmu):
+    '''
+    Tests that storing to RAM works, but storing to ROM raises an error and
+    leaves it unchanged
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.r.a = 0x42
+    cpu.STA(0x2000)
+    assert divide_mmu.read(0x2000) == 0x42
+
+    original = divide_mmu.read(0x8000)
+    with pytest.raises(ReadOnlyError):
+        cpu.STA(0x8000)
+    assert divide_mmu.read(0x8000) == original
+
+
+@pytest.mark.parametrize("trace", [None, lambda name, value: None])
+def test_push_current_registers(divide_mmu, trace):
+    '''
+    Tests that PHA and PHP push the registers as they are when the
+    instruction runs, not as they were when the processor was set up
+    '''
+    divide_mmu.memory[0x1000:0x1002] = bytes((0x48, 0x08))
+    cpu = Processor(divide_mmu, program_counter=0x1000)
+    cpu.trace = trace
+    pushed = []
+    cpu.stack_push = pushed.append
+
+    cpu.r.a = 0x42
+    cpu.r.set_flag(C_FLAG)
+    cpu.step()
+    cpu.step()
+    assert pushed == [0x42, cpu.r.p]
+    assert cpu.r.p & C_FLAG
+
+
+def test_tables_made_when_used(divide_mmu):
+    '''
+    Tests that the tables of decoded instructions and blocks are only made
+    the first time they are needed
+    '''
+    tables = ('_decoded', '_blocks', '_ram_blocks', '_ram_counts')
+    cpu = Processor(divide_mmu)
+    assert not set(tables) & set(vars(cpu))
+
+    cpu.run(20)
+    assert set(tables) <= set(vars(cpu))
+    assert cpu._blocks[0x8000] is not None
+
+    with pytest.raises(AttributeError):
+        cpu._not_a_table
+
+
+def test_compile_rom(divide_mmu):
+    '''
+    Tests that compiling the ROM ahead of time follows the programme through
+    its branches, and gives the same result as running it uncompiled
+    '''
+    cpu = Processor(divide_mmu)
+    assert cpu.compile_rom(0x8000, 0x8000) == 6
+    compiled = [addr for addr, block in enumerate(cpu._blocks) if block]
+    assert compiled == [0x8000, 0x8017, 0x8031, 0x8037, 0x803a, 0x8040]
+
+    # Only code the programme can reach is decoded, not the padding after it
+    assert sum(decoded is not None for decoded in cpu._decoded) == 27
+    assert cpu._decoded[0x9000] is None
+
+    cpu.run_until(0x8040)
+
+    divide_mmu.memory[0:0x4000] = bytes(0x4000)
+    plain = Processor(divide_mmu)
+    plain.run_until(0x8040)
+    assert (cpu.r.a, cpu.r.x, cpu.r.y, cpu.r.p, cpu.cycles) == \
+        (plain.r.a, plain.r.x, plain.r.y, plain.r.p, plain.cycles)
+
+
+def test_stack(divide_mmu):
+    '''
+    Tests that the stack grows down from the top of the stack page, and that
+    values are pulled back off in reverse order
+    '''
+    cpu = Processor(divide_mmu)
+    cpu.stack_push(0x12)
+    cpu.stack_push_word(0x3456)
+    assert divide_mmu.read(0x01ff) == 0x12
+    assert divide_mmu.read(0x01fe) == 0x34
+    assert divide_mmu.read(0x01fd) == 0x56
+    assert cpu.r.sp == 0xfc
+
+    assert cpu.stack_pull_word() == 0x3456
+    assert cpu.stack_pull() == 0x12
+    assert cpu.r.sp == 0xff
+
+
+def test_subroutine(divide_mmu):
+    '''
+    Tests that a subroutine returns to the instruction after the JSR, and
+    that PHA and PLA restore the accumulator
+    '''
+    # $1000 JSR $1010, $1003 NOP
+    # $1010 PHA, LDA #$00, PLA, RTS
+    divide_mmu.memory[0x1000:0x1004] = bytes((0x20, 0x10, 0x10, 0xea))
+    divide_mmu.memory[0x1010:0x1015] = bytes((0x48, 0xa9, 0x00, 0x68, 0x60))
+    cpu = Processor(divide_mmu, program_counter=0x1000)
+    cpu.r.a = 0x42
+
+    assert cpu.run_until(0x1003) == 5
+    assert cpu.r.a == 0x42
+    assert cpu.r.sp == 0xff
+
+
+def test_break(divide_mmu):
+    '''
+    Tests that BRK pushes the return address and status with the break flag
+    set, then sets the interrupt flag and jumps to the BRK vector
+    '''
+    divide_mmu.memory[0xfffe:0x10000] = bytes((0x34, 0x12))
+    cpu = Processor(divide_mmu, program_counter=0x1000)
+    cpu.r.p = U_FLAG | C_FLAG
+    cpu.r.pc = 0x1001
+    cpu.BRK(None)
+
+    assert cpu.r.pc == 0x1234
+    assert cpu.r.p == U_FLAG | B_FLAG | I_FLAG | C_FLAG
+    assert cpu.stack_pull() == U_FLAG | B_FLAG | C_FLAG
+    assert cpu.stack_pull_word() == 0x1002
+
+
+@pytest.mark.parametrize("instruction, value, expected", [
+    ('INC', 0x41, 0x42),
+    ('INC', 0xff, 0x00),
+    ('DEC', 0x42, 0x41),
+    ('DEC', 0x00, 0xff),
+])
+def test_increment_memory(divide_mmu, instruction, value, expected):
+    '''
+    Tests that INC and DEC write the result back to the address they read
+    from, and set the zero and negative flags from it
+    '''
+    cpu = Processor(divide_mmu)
+    divide_mmu.write(0x2000, value)
+    getattr(cpu, instruction)(0x2000)
+
+    assert divide_mmu.read(0x2000) == expected
+    assert cpu.r.get_flag(Z_FLAG) == (expected == 0)
+    assert cpu.r.get_flag(N_FLAG) == bool(expected & 0x80)
+
+    # Memory in ROM can't be changed
+    with pytest.raises(ReadOnlyError):
+        getattr(cpu, instruction)(0x8000)
+
+
+@pytest.mark.parametrize("instruction, value, carry, expected, carry_out", [
+    ('ASL', 0x41, True, 0x82, False),
+    ('ASL', 0x80, False, 0x00, True),
+    ('LSR', 0x82, True, 0x41, False),
+    ('LSR', 0x01, False, 0x00, True),
+    ('ROL', 0x41, True, 0x83, False),
+    ('ROL', 0x80, False, 0x00, True),
+    ('ROR', 0x82, True, 0xc1, False),
+    ('ROR', 0x01, False, 0x00, True),
+])
+def test_shift_memory(divide_mmu, instruction, value, carry, expected,
+                      carry_out):
+    '''
+    Tests that shifts and rotates give the same result on memory as on the
+    accumulator, writing it back to the address they read from
+    '''
+    cpu = Processor(divide_mmu)
+    divide_mmu.write(0x2000, value)
+    cpu.r.set_flag(C_FLAG, carry)
+    getattr(cpu, instruction)(0x2000)
+
+    assert divide_mmu.read(0x2000) == expected
+    assert cpu.r.get_flag(C_FLAG) == carry_out
+    assert cpu.r.get_flag(Z_FLAG) == (expected == 0)
+    assert cpu.r.get_flag(N_FLAG) == bool(expected & 0x80)
+
+    cpu.r.a = value
+    cpu.r.set_flag(C_FLAG, carry)
+    getattr(cpu, instruction)('a')
+    assert cpu.r.a == expected
+    assert cpu.r.get_flag(C_FLAG) == carry_out
+
+    # Memory in ROM can't be changed
+    with pytest.raises(ReadOnlyError):
+        getattr(cpu, instruction)(0x8000)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (0x00, 0), (0x01, 1), (0x7f, 127), (0x80, -128), (0xfe, -2), (0xff, -1),
+])
+def test_twos_comp(divide_mmu, value, expected):
+    '''
+    Tests conversion of a byte from two's complement
+    '''
+    cpu = Processor(divide_mmu)
+    assert cpu.from_twos_comp(value) == expected
+
+
+def test_ram_blocks(divide_mmu):
+    '''
+    Tests that code run often from writable memory is compiled into a block,
+    and that the block is not used once the code has changed
+    '''
+    # $1000 LDA #$05, loop: INX, BNE loop, $1005 JMP $1005
+    code = bytes((0xa9, 0x05, 0xe8, 0xd0, 0xfd, 0x4c, 0x05, 0x10))
+    divide_mmu.memory[0x1000:0x1008] = code
+    cpu = Processor(divide_mmu, program_counter=0x1000)
+
+    assert cpu.run_until(0x1005) == 1 + 2*0x100
+    assert cpu._ram_blocks[0x1002] is not None
+    assert cpu.r.a == 0x05
+
+    # Change the loop to count up y instead, from $fe
+    divide_mmu.memory[0x1002] = 0xc8
+    cpu.r.x = 0
+    cpu.r.y = 0xfe
+    cpu.r.pc = 0x1002
+    assert cpu.run_until(0x1005) == 4
+    assert (cpu.r.x, cpu.r.y) == (0, 0)
+
+    # Loop that writes over its own code: LDA #$05, STA $0206, LDA #$00 (the
+    # operand just written), STA $10, LDA #$00, STA $0206, JMP $0200
+    code = bytes.fromhex('a9 05 8d 06 02 a9 00 85 10 a9 00 8d 06 02 4c 00 02')
+    results = []
+    for batch in (False, True):
+        divide_mmu.memory[0x200:0x200 + len(code)] = code
+        divide_mmu.memory[0x10] = 0
+        cpu = Processor(divide_mmu, program_counter=0x200)
+        if batch:
+            cpu.run(700)
+            assert cpu._ram_blocks[0x200] is not None
+        else:
+            for _ in range(700):
+                cpu.step()
+        results.append((cpu.r.pc, cpu.r.a, cpu.r.p, cpu.cycles,
+                        bytes(divide_mmu.memory[:0x300])))
+    assert results[0] == results[1]
+    assert divide_mmu.memory[0x10] == 0x05
+
+    # Only the start of a hot loop is compiled: LDX #$00, 20 NOPs, DEX, BNE
+    code = bytes.fromhex('a2 00' + 20*'ea' + 'ca d0 e9')
+    divide_mmu.memory[0x1000:0x1000 + len(code)] = code
+    cpu = Processor(divide_mmu, program_counter=0x1000)
+    assert cpu.run_until(0x1019) == 1 + 22*0x100
+    compiled = [addr for addr, block in enumerate(cpu._ram_blocks)
+                if block is not None]
+    assert compiled == [0x1002]
+
+
+def test_ram_blocks_stack_page(divide_mmu):
+    '''
+    Tests that a block of code in the stack page stops when a push writes
+    over its own code, when the stack is not in page 1
+    '''
+    # LDX #$07, TXS, LDA #$05, PHA (over the next operand), LDA #$00,
+    # STA $10, LDA #$00, STA $0307, JMP $0300
+    code = bytes.fromhex('a2 07 9a a9 05 48 a9 00 85 10 a9 00 8d 07 03 '
+                         '4c 00 03')
+    results = []
+    for batch in (False, True):
+        divide_mmu.memory[0x300:0x300 + len(code)] = code
+        divide_mmu.memory[0x10] = 0
+        cpu = Processor(divide_mmu, program_counter=0x300, stack_page=3)
+        if batch:
+            cpu.run(900)
+            assert cpu._ram_blocks[0x300] is not None
+        else:
+            for _ in range(900):
+                cpu.step()
+        results.append((cpu.r.pc, cpu.r.a, cpu.r.sp, cpu.r.p, cpu.cycles,
+                        bytes(divide_mmu.memory[:0x400])))
+    assert results[0] == results[1]
+    assert divide_mmu.memory[0x10] == 0x05
@@ -24,10 +24,10 @@ def example_memory():
 def test_address_length(example_memory):
     '''
     6502 uses 16-bit addresses, so total addressable MMU should have
-    a 0xffff total number of addressable spaces
+    a 0x10000 total number of addressable spaces
     '''
     mems = example_memory
-    assert len(mems.memory) == 0xffff
+    assert len(mems.memory) == 0x10000
 
 
 def test_addblock(example_memory):
@@ -83,3 +83,87 @@ def test_write_invalid(example_memory):
 
     with pytest.raises(ReadOnlyError):
         example_memory.write(addr, newvalue)
+
+
+def test_addblock_top_of_memory(example_memory):
+    '''
+    Tests that a block can run right up to the top of the address space,
+    with its final byte stored at 0xffff
+    '''
+    new_block = (0xff00, 0x100, 'ROM', True, 0x100*[0xea])
+    example_memory.add_block(*new_block)
+    assert example_memory.read(0xffff) == 0xea
+    assert example_memory.is_read_only(0xffff)
+
+
+def test_add_block_outside_memory(example_memory):
+    '''
+    Tests that block that runs past the end of the 16 bit address space
+    cannot be added
+    '''
+    new_block = (0xff00, 0x200, 'ROM', True)
+    with pytest.raises(MemoryRangeError):
+        example_memory.add_block(*new_block)
+    assert len(example_memory.memory) == 0x10000
+
+
+@pytest.mark.parametrize("data", [b'\x42\x55\x11', bytearray(b'\x42\x55\x11'),
+                                  memoryview(b'\x42\x55\x11'), [0x42, 0x55, 0x11]])
+def test_addblock_data_types(example_memory, data):
+    '''
+    Tests that block data can be given as bytes-like objects or a list
+    '''
+    example_memory.add_block(0x5000, 0x3, 'ROM', True, data)
+    assert example_memory.memory[0x5000:0x5003] == b'\x42\x55\x11'
+
+
+def test_addblock_sized_from_data(example_memory):
+    '''
+    Tests that a block given no length is sized to fit its data
+    '''
+    new_block = (0x5000, None, 'ROM', True, [0x42, 0x55, 0x11])
+    example_memory.add_block(*new_block)
+    assert example_memory.blocks[-1]['length'] == 3
+    assert example_memory.is_read_only(0x5002)
+    assert not example_memory.is_read_only(0x5003)
+
+
+def test_addblock_data_too_long(example_memory):
+    '''
+    Tests that data which doesn't fit in the block is still cut short, as it
+    used to be, but not silently
+    '''
+    new_block = (0x5000, 0x2, 'ROM', True, [0x42, 0x55, 0x11])
+    with pytest.warns(DeprecationWarning):
+        example_memory.add_block(*new_block)
+    assert example_memory.blocks[-1]['length'] == 2
+    assert example_memory.memory[0x5000:0x5003] == b'\x42\x55\x00'
+
+
+@pytest.mark.parametrize("start_addr, length", [
+    (0x0000, 0x10),
+    (0x0000, 0x3fff),
+    (0x1000, 0x10),
+    (0x3ffe, 0x10),
+])
+def test_add_overlapping_block(example_memory, start_addr, length):
+    '''
+    Tests that a block can't be added if it shares any address with an
+    existing block, including starting or finishing at the same address
+    '''
+    with pytest.raises(MemoryRangeError):
+        example_memory.add_block(start_addr, length, 'Overlap')
+
+
+def test_add_block_containing_block(example_memory):
+    '''
+    Tests that a block can't be added around an existing, smaller block, but
+    can be added right next to it
+    '''
+    example_memory.add_block(0x5000, 0x100, 'Small')
+    with pytest.raises(MemoryRangeError):
+        example_memory.add_block(0x4000, 0x2000, 'Large')
+
+    example_memory.add_block(0x3fff, 0x1, 'Before')
+    example_memory.add_block(0x5100, 0x100, 'After')
+    assert example_memory.blocks[-1]['name'] == 'After'